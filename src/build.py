@@ -0,0 +1,137 @@
+import importlib
+import sys
+import os
+
+currentdir = os.curdir
+import threading
+from time import time
+
+sys.path.append(os.path.join("src"))  # add to the module search path
+
+import depfiles
+import global_constants
+import iron_horse
+import utils
+from worker_pool import WorkerPool
+
+# runs the lang, nml, graphics and docs stages in one process, so the model is only loaded once, and one worker pool is shared
+# usage: python src/build.py PW ROSTER SC SD PROFILE [stage ...], with all stages run if none are named
+# the makefile targets each call this with a single stage, so make still decides what needs rebuilding
+
+# stage name: (module, stages it depends on)
+# modules are imported when the stage runs, as render_lang and render_nml write files and print when imported
+stages = {
+    "lang": ("render_lang", []),
+    "nml": ("render_nml", []),
+    "graphics": ("render_graphics", []),
+    "docs": ("render_docs", ["lang", "graphics"]),
+}
+# graphics is started first, it's slowest, and as its work is done in the pool workers, the other stages can run while it does
+stage_order = ["graphics", "lang", "nml", "docs"]
+# stages that take the shared worker pool
+pool_stages = ["graphics", "docs"]
+
+
+class StageThread(threading.Thread):
+    """Runs a stage in the background, holding on to any exception so it can be raised in the main thread."""
+
+    def __init__(self, stage, worker_pool):
+        super().__init__(name=stage)
+        self.stage = stage
+        self.worker_pool = worker_pool
+        self.error = None
+
+    def run(self):
+        try:
+            run_stage(self.stage, self.worker_pool)
+        except BaseException as error:
+            self.error = error
+
+    def wait(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def run_stage(stage, worker_pool):
+    start = time()
+    # record from before the import, as some render scripts read files when imported, and stages sharing a thread must each get their own depfile
+    depfiles.start_recording()
+    module = importlib.import_module(stages[stage][0])
+    if stage in pool_stages:
+        module.main(worker_pool=worker_pool)
+    else:
+        module.main()
+    depfiles.stop_recording()
+    # per stage, so a stage that's slower here than when run alone is easy to spot
+    print("[BUILD]", stage, "done", format((time() - start), ".2f") + "s")
+
+
+def setup_chameleon_cache():
+    # chameleon reads CHAMELEON_CACHE once, when it's first imported, and render_lang and render_nml import it when they're imported
+    # so it has to be set before any stage is imported, otherwise later stages get no template cache, and docs recompiles a template for every vehicle
+    chameleon_cache_path = os.path.join(
+        currentdir, global_constants.chameleon_cache_dir
+    )
+    if not os.path.exists(chameleon_cache_path):
+        os.mkdir(chameleon_cache_path)
+    os.environ["CHAMELEON_CACHE"] = chameleon_cache_path
+
+
+def get_requested_stages(argv):
+    # stage names follow the 5 makefile args
+    requested_stages = argv[6:]
+    for stage in requested_stages:
+        if stage not in stages:
+            raise BaseException(
+                "Unknown build stage '" + stage + "', valid stages are:",
+                list(stages.keys()),
+            )
+    if len(requested_stages) == 0:
+        return list(stages.keys())
+    return requested_stages
+
+
+def main():
+    print("[BUILD] build.py")
+    start = time()
+    requested_stages = get_requested_stages(sys.argv)
+    makefile_args = utils.get_makefile_args(sys)
+    num_pool_workers = makefile_args.get("num_pool_workers", 0)
+    setup_chameleon_cache()
+
+    # load the model once, before the pool is created, so the workers inherit it
+    iron_horse.main()
+    iron_horse.get_active_rosters()
+    # import the pool stage modules before forking too, so the workers have them without re-importing
+    for stage in pool_stages:
+        if stage in requested_stages:
+            importlib.import_module(stages[stage][0])
+    worker_pool = WorkerPool(num_pool_workers)
+
+    # stage name: thread, for stages running in the background
+    stage_threads = {}
+    for stage in stage_order:
+        if stage not in requested_stages:
+            continue
+        for dependency in stages[stage][1]:
+            # dependencies not requested are assumed to be already built, e.g. by an earlier make target
+            if dependency in stage_threads:
+                stage_threads.pop(dependency).wait()
+        if stage in pool_stages and num_pool_workers > 0:
+            # the work is done in the pool workers, so this process is mostly idle, and can get on with the next stage
+            stage_threads[stage] = StageThread(stage, worker_pool)
+            stage_threads[stage].start()
+        else:
+            # with no pool workers, everything is done in this process anyway, so just run the stages in order
+            run_stage(stage, worker_pool)
+    for stage_thread in stage_threads.values():
+        stage_thread.wait()
+
+    worker_pool.close()
+    print("[BUILD] done", format((time() - start), ".2f") + "s")
+
+
+# wrapped in a main() function so this can be called explicitly, because unexpected multiprocessing fork bombs are bad
+if __name__ == "__main__":
+    main()
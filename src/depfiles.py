@@ -0,0 +1,107 @@
+import os.path
+
+currentdir = os.curdir
+
+import sys
+import threading
+
+import global_constants
+
+# make depfiles, listing the files each render script actually read, so the makefile doesn't have to guess with find-files
+# reads are found with an audit hook on open, which also sees python modules being imported, templates, lang files and pngs
+# import this before iron_horse in render scripts, so reads made while importing are recorded
+# new files aren't seen until something that's already a prerequisite changes, but in practice new files are always wired up by editing an existing one
+
+# only files in the repo are prerequisites, and not the generated or cached ones
+excluded_dirs = [
+    global_constants.generated_files_dir,
+    global_constants.chameleon_cache_dir,
+    global_constants.graphics_cache_dir,
+    "docs",
+    ".git",
+    ".nmlcache",
+    "__pycache__",
+]
+
+# files read outside of a recording, e.g. loading the model, or importing modules, which every render script depends on
+shared_input_paths = set()
+# files read by the render script running in each thread, build.py can run several at once
+recording = threading.local()
+
+
+def get_repo_path(path):
+    # returns the path relative to the repo, or None if the file isn't a source file in the repo
+    if not isinstance(path, str):
+        # file descriptors and bytes paths aren't used by any of the render scripts
+        return None
+    path = os.path.relpath(os.path.abspath(path))
+    if path.startswith(".."):
+        return None
+    if any(dir_name in excluded_dirs for dir_name in path.split(os.sep)[:-1]):
+        return None
+    return path
+
+
+def record_open(event, args):
+    if event != "open":
+        return
+    if getattr(recording, "ignoring_reads", False):
+        return
+    input_paths = getattr(recording, "input_paths", None)
+    if input_paths is None:
+        input_paths = shared_input_paths
+    # mode is None for os.open, which isn't used for reading source files here
+    if args[1] is not None and "r" in args[1]:
+        input_paths.add(args[0])
+
+
+sys.addaudithook(record_open)
+
+
+def start_recording():
+    # reads in this thread are recorded for this render script only, until stop_recording()
+    # doesn't restart if already recording, so build.py can start recording before importing a render script, and the script's main() can too
+    if getattr(recording, "input_paths", None) is None:
+        recording.input_paths = set()
+
+
+def stop_recording():
+    recording.input_paths = None
+
+
+def ignore_reads():
+    # reads in this thread aren't recorded until record_reads(), for files that are read but aren't inputs, e.g. hashing all the source to validate the model snapshot
+    recording.ignoring_reads = True
+
+
+def record_reads():
+    recording.ignoring_reads = False
+
+
+def write_depfile(target, depfile_name, extra_input_paths=()):
+    # extra_input_paths is for files read in pool workers, the audit hook only sees reads in this process
+    input_paths = set(shared_input_paths)
+    input_paths.update(getattr(recording, "input_paths", None) or [])
+    input_paths.update(extra_input_paths)
+    # modules imported before this module, including the render script itself
+    for module in list(sys.modules.values()):
+        if getattr(module, "__file__", None) is not None:
+            input_paths.add(module.__file__)
+    prerequisites = set()
+    for input_path in input_paths:
+        repo_path = get_repo_path(input_path)
+        if repo_path is not None and os.path.isfile(repo_path):
+            prerequisites.add(repo_path.replace(" ", "\\ "))
+    prerequisites = sorted(prerequisites)
+    # target must match the makefile exactly, so no leading ./
+    target = os.path.normpath(target)
+    depfile_path = os.path.join(
+        currentdir, global_constants.generated_files_dir, depfile_name + ".d"
+    )
+    depfile_path_tmp = depfile_path + "." + str(os.getpid()) + ".tmp"
+    with open(depfile_path_tmp, "w") as depfile:
+        depfile.write(target + ": " + " \\\n ".join(prerequisites) + "\n")
+        # an empty rule for each prerequisite, so make doesn't fail if one is deleted or renamed (same as gcc -MP)
+        for prerequisite in prerequisites:
+            depfile.write("\n" + prerequisite + ":\n")
+    os.replace(depfile_path_tmp, depfile_path)
@@ -39,7 +39,7 @@ def main():
 
     # TODO sort order
 
-    consists = iron_horse.ActiveRosters().consists_in_buy_menu_order
+    consists = iron_horse.get_active_rosters().consists_in_buy_menu_order
     g.add(*consists)
 
     g.write('iron_horse_grfpy_edition.grf')
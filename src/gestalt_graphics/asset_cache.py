@@ -0,0 +1,87 @@
+import os.path
+
+from collections import OrderedDict
+
+from PIL import Image
+
+# enough for all the chassis, roofs, templates, pantographs and cargo items in a run, plus their derived images
+asset_cache_max_items = 1024
+
+
+class AssetCache(object):
+    """
+    Per-process LRU cache of source images, and images derived from them (masks, crops, angle sprites, composites etc).
+    Many consists use the same chassis, roofs, templates and so on, so this saves opening and decoding the same pngs repeatedly.
+    Keyed on mtime as well as path, so an edited file is re-read; the stale entry just ages out.
+    Cached images are shared, so callers must treat them as read-only; crop() returns a new image, paste() into them is not ok.
+    """
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        # hits and misses per derivation name, for reporting
+        self.stats = {}
+
+    def get_image(self, path):
+        return self.get_composite([path], None, None)
+
+    def get_derived(self, path, derivation, make_derived):
+        # derivation is a hashable description of what make_derived does, e.g. a name and crop box
+        # make_derived is called with the source image on a miss, and must not modify it
+        return self.get_composite(
+            [path], derivation, lambda images: make_derived(images[0])
+        )
+
+    def get_composite(self, paths, derivation, make_composite):
+        # as get_derived, but for a value made from more than one source image, make_composite is called with a list of the images
+        key = (
+            tuple((path, os.stat(path).st_mtime_ns) for path in paths),
+            derivation,
+        )
+        stats = self.stats.setdefault(
+            "source" if derivation is None else derivation[0], [0, 0]
+        )
+        if key in self.items:
+            stats[0] += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+        stats[1] += 1
+        if derivation is None:
+            source_image = Image.open(paths[0])
+            value = source_image.copy()
+            # don't leave open files around, it can hit open file limits on macOs
+            source_image.close()
+        else:
+            value = make_composite([self.get_image(path) for path in paths])
+        self.items[key] = value
+        if len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+        return value
+
+    def pop_stats(self):
+        stats = self.stats
+        self.stats = {}
+        return stats
+
+
+asset_cache = AssetCache(asset_cache_max_items)
+
+
+def add_stats(total_stats, stats):
+    for name, (hits, misses) in stats.items():
+        total = total_stats.setdefault(name, [0, 0])
+        total[0] += hits
+        total[1] += misses
+
+
+def report_stats(total_stats):
+    for name, (hits, misses) in sorted(total_stats.items()):
+        print(
+            "Asset cache",
+            name + ":",
+            hits,
+            "hits,",
+            misses,
+            "misses;",
+            str(int(100 * (hits / (hits + misses)))) + "% hit rate",
+        )
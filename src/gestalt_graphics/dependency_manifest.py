@@ -0,0 +1,97 @@
+import os.path
+
+currentdir = os.curdir
+
+import json
+
+import global_constants
+
+# the inputs each graphics task read last time it ran, so render_graphics can skip tasks where nothing has changed, without even checking the render cache
+dependency_manifest_path = os.path.join(
+    currentdir, global_constants.generated_files_dir, "graphics", "dependencies.json"
+)
+
+
+def get_file_stat(path):
+    # size and mtime are enough to spot a changed file, and much cheaper than hashing it
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class DependencyManifest(object):
+    """
+    Manifest of graphics tasks, as task id: the render plan digest, pipeline version, and the stats of the files read and written.
+    The render plan digest covers everything the task takes from the vehicle modules, the files are the source pngs, chassis, roofs, cargo sprites etc.
+    Pool workers record the files each pipeline reads, the main process decides which tasks are up to date, and saves the manifest.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        # (input paths, output path) for each output written by this process, see pop_records()
+        self.records = []
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as manifest_file:
+                self.entries = json.load(manifest_file)
+
+    def record(self, input_paths, output_path):
+        # called by pipelines in the worker, for each output they write
+        self.records.append((input_paths, output_path))
+
+    def pop_records(self):
+        records = self.records
+        self.records = []
+        return records
+
+    def is_up_to_date(self, task_id, render_plan_digest, pipeline_version):
+        entry = self.entries.get(repr(task_id), None)
+        if entry is None:
+            return False
+        if entry["render_plan_digest"] != render_plan_digest:
+            return False
+        if entry["pipeline_version"] != pipeline_version:
+            return False
+        for path, file_stat in list(entry["inputs"].items()) + list(
+            entry["outputs"].items()
+        ):
+            if get_file_stat(path) != file_stat:
+                return False
+        return True
+
+    def update(self, task_id, render_plan_digest, pipeline_version, records):
+        # main process only, called once the task has run, so the outputs are in place
+        inputs = {}
+        outputs = {}
+        for input_paths, output_path in records:
+            for input_path in input_paths:
+                inputs[input_path] = get_file_stat(input_path)
+            outputs[output_path] = get_file_stat(output_path)
+        self.entries[repr(task_id)] = {
+            "render_plan_digest": render_plan_digest,
+            "pipeline_version": pipeline_version,
+            "inputs": inputs,
+            "outputs": outputs,
+        }
+
+    def get_input_paths(self, task_ids):
+        # all the files read by the tasks, as recorded when they last ran
+        result = set()
+        for task_id in task_ids:
+            entry = self.entries.get(repr(task_id), None)
+            if entry is not None:
+                result.update(entry["inputs"].keys())
+        return result
+
+    def save(self):
+        # main process only, written atomically as it can be read by a later run while this one is still going
+        path_tmp = self.path + "." + str(os.getpid()) + ".tmp"
+        with open(path_tmp, "w") as manifest_file:
+            json.dump(self.entries, manifest_file, indent=4, sort_keys=True)
+        os.replace(path_tmp, self.path)
+
+
+dependency_manifest = DependencyManifest(dependency_manifest_path)
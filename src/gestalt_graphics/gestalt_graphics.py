@@ -19,8 +19,6 @@ class GestaltGraphics(object):
         # specific alt livery for specific company colour choices
         # this is only used by engines as of July 2020, but we provide a default value here to avoid requiring getattr() in many places, which was masking errors
         self.alternative_cc_livery = None  # over-ride as needed in subclasses
-        # sometimes processing may depend on another generated vehicle spritesheet, so there are multiple processing priorities, 1 = highest
-        self.processing_priority = 1
         # default value for optional mask layer, this is JFDI for 2022, may need converting a more generic spritelayers structure in future
         # set directly by the consist self.gestalt_graphics.add_masked_overlay = True, or by kwargs on a specific gestalt subclass
         self.add_masked_overlay = False
@@ -46,6 +44,15 @@ class GestaltGraphics(object):
         # stub, for compatibility reasons
         return ["single_row"]
 
+    def get_render_config(self):
+        # the gestalt config that changes the rendered spritesheets, for the render cache key and render plan digest
+        # fields are listed explicitly, so anything without a stable repr can't sneak in, extend in subclasses as needed
+        return {
+            "gestalt": self.__class__.__name__,
+            "alternative_cc_livery": self.alternative_cc_livery,
+            "add_masked_overlay": self.add_masked_overlay,
+        }
+
 
 class GestaltGraphicsEngine(GestaltGraphics):
     """
@@ -127,8 +134,12 @@ class GestaltGraphicsRandomisedWagon(GestaltGraphics):
             ]
         )
         self.dice_colour = kwargs["dice_colour"]
-        # randomised buy menu sprites depend on generated vehicle spritesheet, so defer processing to round 2
-        self.processing_priority = 2
+        # randomised buy menu sprites depend on generated vehicle spritesheets, the pipeline declares that so render_graphics can schedule it
+
+    def get_render_config(self):
+        result = super().get_render_config()
+        result["dice_colour"] = self.dice_colour
+        return result
 
     @property
     def nml_template(self):
@@ -164,6 +175,15 @@ class GestaltGraphicsVisibleCargo(GestaltGraphics):
         if self.has_piece:
             self.piece_type = kwargs.get("piece")
 
+    def get_render_config(self):
+        result = super().get_render_config()
+        result["weathered_variants"] = self.weathered_variants
+        result["has_cover"] = self.has_cover
+        result["has_bulk"] = self.has_bulk
+        result["has_piece"] = self.has_piece
+        result["piece_type"] = getattr(self, "piece_type", None)
+        return result
+
     @property
     def generic_rows(self):
         # map unknown cargos to sprites for some other label
@@ -323,6 +343,12 @@ class GestaltGraphicsBoxCarOpeningDoors(GestaltGraphics):
         # note also that box cars have only one recolour map for *cargo*, which should be on 'DFLT',
         self.weathered_variants = weathered_variants
 
+    def get_render_config(self):
+        result = super().get_render_config()
+        result["id_base"] = self.id_base
+        result["weathered_variants"] = self.weathered_variants
+        return result
+
     @property
     def generic_rows(self):
         utils.echo_message(
@@ -362,6 +388,12 @@ class GestaltGraphicsCaboose(GestaltGraphics):
         # but one livery remap is supported for this gestalt
         self.recolour_map = recolour_map
 
+    def get_render_config(self):
+        result = super().get_render_config()
+        result["num_variations"] = self.num_variations
+        result["recolour_map"] = self.recolour_map
+        return result
+
     @property
     def generic_rows(self):
         utils.echo_message(
@@ -422,6 +454,16 @@ class GestaltGraphicsIntermodalContainerTransporters(GestaltGraphics):
             8: 8,  # middle: middle
         }
 
+    def get_render_config(self):
+        result = super().get_render_config()
+        result["consist_ruleset"] = self.consist_ruleset
+        result["num_extra_layers_for_spritelayer_cargos"] = (
+            self.num_extra_layers_for_spritelayer_cargos
+        )
+        result["cargo_sprites_are_asymmetric"] = self.cargo_sprites_are_asymmetric
+        result["asymmetric_row_map"] = self.asymmetric_row_map
+        return result
+
     def get_output_row_types(self):
         # 2 liveries * 4 variants so 8 empty rows, we're only using the composited sprites pipeline for chassis compositing, containers are provided on separate layer
         # note to self, remarkably adding multiple empty rows appears to just work here :o
@@ -543,6 +585,15 @@ class GestaltGraphicsAutomobilesTransporter(GestaltGraphics):
         # derive number of layers for cargo sprites
         self.num_extra_layers_for_spritelayer_cargos = len(spritelayer_cargo_layers)
 
+    def get_render_config(self):
+        result = super().get_render_config()
+        result["consist_ruleset"] = self.consist_ruleset
+        result["num_extra_layers_for_spritelayer_cargos"] = (
+            self.num_extra_layers_for_spritelayer_cargos
+        )
+        result["cargo_sprites_are_asymmetric"] = self.cargo_sprites_are_asymmetric
+        return result
+
     def get_output_row_types(self):
         # !! the actual number of variants needs decided - are we having articulated variants or just single units?
         # 2 liveries * 4 variants so 8 empty rows, we're only using the composited sprites pipeline for chassis compositing, containers are provided on separate layer
@@ -704,6 +755,11 @@ class GestaltGraphicsSimpleBodyColourRemaps(GestaltGraphics):
         # there is no support here for weathered variants that depend on hand-drawn pixels, it's all recolour maps as of March 2022 - could change if needed
         self.weathered_variants = weathered_variants
 
+    def get_render_config(self):
+        result = super().get_render_config()
+        result["weathered_variants"] = self.weathered_variants
+        return result
+
     @property
     def generic_rows(self):
         utils.echo_message(
@@ -790,6 +846,14 @@ class GestaltGraphicsConsistSpecificLivery(GestaltGraphics):
                 max([int(i) + 1 for i in self.cargo_row_map["DFLT"]])
             )
 
+    def get_render_config(self):
+        result = super().get_render_config()
+        result["spriterow_group_mappings"] = self.spriterow_group_mappings
+        result["consist_ruleset"] = self.consist_ruleset
+        result["consist_positions_ordered"] = self.consist_positions_ordered
+        result["num_pantograph_rows"] = getattr(self, "num_pantograph_rows", None)
+        return result
+
     @property
     def nml_template(self):
         # over-ride in sub-classes as needed
@@ -902,6 +966,19 @@ class GestaltGraphicsCustom(GestaltGraphics):
                 num_extra_layers_for_spritelayer_cargos
             )
 
+    def get_render_config(self):
+        result = super().get_render_config()
+        # the properties, not the underscored attributes, as that's what pipelines and templates see
+        result["cargo_row_map"] = self.cargo_row_map
+        result["generic_rows"] = self.generic_rows
+        result["unique_spritesets"] = self.unique_spritesets
+        result["cargo_label_mapping"] = self.cargo_label_mapping
+        result["weathered_variants"] = self.weathered_variants
+        result["num_extra_layers_for_spritelayer_cargos"] = getattr(
+            self, "num_extra_layers_for_spritelayer_cargos", None
+        )
+        return result
+
     @property
     def generic_rows(self):
         # generic rows is normally automated, but for custom, get it from a manully specified property
@@ -0,0 +1,100 @@
+import os.path
+
+currentdir = os.curdir
+
+import json
+
+import global_constants
+
+# digests of the pixels and palette of each generated spritesheet, so an unchanged sheet doesn't need encoding to find that out
+# generated spritesheets are only replaced when they change, as replacing them destroys the nmlc sprite cache
+output_manifest_path = os.path.join(
+    currentdir, global_constants.generated_files_dir, "graphics", "manifest.json"
+)
+
+
+class OutputManifest(object):
+    """
+    Manifest of generated spritesheets, as output file name: digest of the raw pixels and palette, the png options used, plus the file size and mtime.
+    Size and mtime are checked so that a file changed by anything else (render cache restores, make clean, manual edits) is never trusted.
+    Pool workers read the manifest and record their own updates, which are returned to the main process, and saved once per run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        # mtime of the manifest file when it was last read, it's re-read if it changes, so long-lived workers see saves from the main process
+        self.loaded_mtime_ns = None
+        # entries written by this process, see pop_updates()
+        self.updates = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        mtime_ns = os.stat(self.path).st_mtime_ns
+        if mtime_ns == self.loaded_mtime_ns:
+            return
+        with open(self.path) as manifest_file:
+            self.entries = json.load(manifest_file)
+        self.loaded_mtime_ns = mtime_ns
+
+    def is_unchanged(self, output_path, digest, png_options):
+        # True if output_path already holds a spritesheet with this digest, encoded with the same png options
+        if not os.path.exists(output_path):
+            return False
+        self.load()
+        name = os.path.basename(output_path)
+        entry = self.updates.get(name, self.entries.get(name, None))
+        if entry is None:
+            return False
+        stat = os.stat(output_path)
+        return entry == {
+            "digest": digest,
+            "png_options": png_options,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+    def write_spritesheet(self, spritesheet, output_path, png_options):
+        # encodes the spritesheet only if it has changed, once, to a tmp file then renamed, so other pool workers never see a partially written file
+        # returns True if the file was written
+        digest = spritesheet.get_digest()
+        if self.is_unchanged(output_path, digest, png_options):
+            return False
+        # keep the png extension on the tmp file, PIL picks the format from it
+        output_path_tmp = output_path + "." + str(os.getpid()) + ".tmp.png"
+        spritesheet.save(output_path_tmp, png_options)
+        os.replace(output_path_tmp, output_path)
+        stat = os.stat(output_path)
+        self.updates[os.path.basename(output_path)] = {
+            "digest": digest,
+            "png_options": png_options,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+        return True
+
+    def pop_updates(self):
+        updates = self.updates
+        self.updates = {}
+        return updates
+
+    def save(self, updates):
+        # main process only, merges updates from the workers into the manifest, and writes it atomically
+        self.load()
+        self.entries.update(updates)
+        output_dir = os.path.dirname(self.path)
+        # drop entries for files that have gone, to stop stale entries piling up
+        self.entries = {
+            name: entry
+            for name, entry in self.entries.items()
+            if os.path.exists(os.path.join(output_dir, name))
+        }
+        path_tmp = self.path + "." + str(os.getpid()) + ".tmp"
+        with open(path_tmp, "w") as manifest_file:
+            json.dump(self.entries, manifest_file, indent=4, sort_keys=True)
+        os.replace(path_tmp, self.path)
+        self.loaded_mtime_ns = os.stat(self.path).st_mtime_ns
+
+
+output_manifest = OutputManifest(output_manifest_path)
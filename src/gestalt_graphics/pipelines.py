@@ -2,7 +2,6 @@ import os.path
 
 currentdir = os.curdir
 
-import filecmp
 from PIL import Image
 
 import polar_fox
@@ -14,8 +13,12 @@ from polar_fox.graphics_units import (
     TransposeAsymmetricSprites,
 )
 import polar_fox.pixa as pixa
-from polar_fox.pixa import Spritesheet, PieceCargoSprites
+from polar_fox.pixa import Spritesheet
 from gestalt_graphics import graphics_constants
+from gestalt_graphics.render_cache import render_cache
+from gestalt_graphics.asset_cache import asset_cache
+from gestalt_graphics.output_manifest import output_manifest
+from gestalt_graphics.dependency_manifest import dependency_manifest
 
 from grf import PALETTE as DOS_PALETTE
 
@@ -25,11 +28,24 @@ Or they can compose units for more complicated tasks, such as colouring and load
 """
 
 
+# plain lookup tables for .point on body images, much faster than lambdas, which PIL has to call for every index on every row
+body_false_colour_table = [
+    255 if (i in range(178, 192) or i == 0) else i for i in range(256)
+]
+body_mask_table = [0 if i == 255 else 255 for i in range(256)]
+
+
 class Pipeline(object):
+    # render_graphics schedules each pipeline as a separate task, these flags tell it how pipelines for the same consist depend on each other
+    # most pipelines write the generated vehicle spritesheet, over-ride in subclasses that write a different spritesheet (with a suffix)
+    writes_vehicle_spritesheet = True
+    # over-ride in subclasses that read the *generated* vehicle spritesheet for the same consist, they'll be scheduled after the pipelines that write it
+    reads_vehicle_spritesheet = False
+
     def __init__(self):
         # this should be sparse, don't store any consist info in Pipelines, pass at render time
-        # actually, there's nothing to do eh :P
-        pass
+        # the build profile is also set at render time, from the render plan, see run_render_plan()
+        self.build_profile = None
 
     @property
     def vehicle_source_input_path(self):
@@ -57,6 +73,64 @@ class Pipeline(object):
             currentdir, "src", "graphics", "roofs", self.vehicle_unit.roof + ".png"
         )
 
+    @property
+    def spriterow_template_input_path(self):
+        return os.path.join(currentdir, "src", "graphics", "spriterow_template.png")
+
+    def get_output_path(self, output_base_name=None, output_suffix=""):
+        if output_base_name is None:
+            # default to consist name for file name, but can over-ride for e.g. containers by passing something in
+            output_base_name = self.consist.id
+        return os.path.join(
+            currentdir,
+            "generated",
+            "graphics",
+            output_base_name + output_suffix + ".png",
+        )
+
+    def get_dependency_consist_ids(self, consist):
+        # ids of other consists whose *generated* vehicle spritesheets this pipeline reads, render_graphics schedules the pipelines that write those first
+        # over-ride in subclasses as needed
+        return []
+
+    def get_render_cache_input_paths(self):
+        # every file the pipeline reads must be listed here, otherwise changes to that file won't invalidate the render cache
+        # over-ride in subclasses that read more than the vehicle spritesheet
+        return [self.vehicle_source_input_path]
+
+    def get_render_cache_config(self):
+        # anything other than input files that changes the rendered output, extend in subclasses as needed
+        units_config = [
+            (
+                unit.vehicle_length,
+                unit.spriterow_num,
+                unit.chassis,
+                unit.roof,
+                unit.suppress_roof_sprite,
+                unit.symmetry_type,
+            )
+            for unit in self.consist.units
+        ]
+        return [
+            self.__class__.__name__,
+            self.consist.gestalt_graphics.get_render_config(),
+            units_config,
+            self.consist.buy_menu_x_loc,
+        ]
+
+    def restore_from_render_cache(self, output_base_name=None, output_suffix=""):
+        # call this at the start of render(), before any units are built, so a cache hit skips all the pipeline work
+        # the key is kept so that render_common() can store the result on a miss
+        # the build profile changes the labels and png encoding, so it's part of the key
+        input_paths = self.get_render_cache_input_paths()
+        output_path = self.get_output_path(output_base_name, output_suffix)
+        self.render_cache_key = render_cache.get_key(
+            input_paths, [self.get_render_cache_config(), self.build_profile]
+        )
+        # the same inputs are recorded so render_graphics can skip this pipeline next time, if they're unchanged
+        dependency_manifest.record(input_paths, output_path)
+        return render_cache.restore(self.render_cache_key, output_path)
+
     def process_buy_menu_sprite(self, spritesheet):
         # this function is passed (uncalled) into the pipeline, and then called at render time
         # this is so that it has the processed spritesheet available, which is essential for creating buy menu sprites
@@ -110,8 +184,7 @@ class Pipeline(object):
                     + 1,  # allow for 1px coupler / corrider overhang
                     26 + (cc_livery_counter * 30),
                 )
-                custom_buy_menu_sprite = spritesheet.sprites.copy().crop(crop_box_src)
-                spritesheet.sprites.paste(custom_buy_menu_sprite, crop_box_dest)
+                spritesheet.copy_region(crop_box_src, crop_box_dest)
                 # increment x offset for pasting in next vehicle
             x_offset += unit_length_in_pixels
         return spritesheet
@@ -122,49 +195,42 @@ class Pipeline(object):
         # expects to be passed a PIL Image object
         # units is a list of objects, with their config data already baked in (don't have to pass anything to units except the spritesheet)
         # each unit is then called in order, passing in and returning a pixa SpriteSheet
-        # finally the spritesheet is saved
-        if output_base_name is None:
-            # default to consist name for file name, but can over-ride for e.g. containers by passing something in
-            output_base_name = self.consist.id
-        output_path = os.path.join(
-            currentdir,
-            "generated",
-            "graphics",
-            output_base_name + output_suffix + ".png",
+        # finally the spritesheet is saved (if changed), and stored in the render cache
+        # render() is responsible for calling restore_from_render_cache() first, a hit means render_common() is never reached
+        output_path = self.get_output_path(output_base_name, output_suffix)
+        # the final size of the spritesheet is known from the units, so allocate it once, and let units append rows straight into their slots
+        spritesheet_layout = pixa.SpritesheetLayout(
+            width=input_image.size[0], initial_height=input_image.size[1]
         )
-        output_path_tmp = os.path.join(
-            currentdir,
-            "generated",
-            "graphics",
-            output_base_name + output_suffix + ".new.png",
-        )
-        spritesheet = pixa.make_spritesheet_from_image(input_image, DOS_PALETTE)
+        for unit in units:
+            spritesheet_layout.add_rows(unit.appended_height)
+        spritesheet = spritesheet_layout.make_spritesheet(input_image, DOS_PALETTE)
 
         for unit in units:
             spritesheet = unit.render(spritesheet)
+        spritesheet.crop_to_filled_height()
         # I don't normally leave commented-out code behind, but I'm bored of looking in the PIL docs for how to show the image during compile
         # if self.consist.id == 'velaro_thing':
-        # spritesheet.sprites.show()
+        # spritesheet.crop((0, 0) + spritesheet.size).show()
 
-        # save a tmp file first and compare to existing file (if any)
+        # the output manifest has a digest of the pixels of the existing file (if any), so unchanged files aren't encoded or replaced
         # this prevents destroying the nmlc sprite cache with every graphics run by needlessly replacing the files
-        # !! maybe this should be moved into pixa?
-        if os.path.exists(output_path_tmp):
-            # tmp path should not exist, if it does we either have
-            # - the same filename being written more than once, in multiprocessing pool, which suggests duplicates in some list of items to be rendered
-            # - artefacts from a previous failed compile
-            # either way, raise, because this was a previous source of intermittent compile failures
-            # (problem was tmp file being deleted by one pool worker whilst another pool worker was still trying to work with it)
-            raise (BaseException("Exists:", output_path_tmp))
-        if os.path.exists(output_path):
-            # save tmp file
-            spritesheet.save(output_path_tmp)
-            if not filecmp.cmp(output_path, output_path_tmp):
-                print("replacing", output_path)
-                spritesheet.save(output_path)
-            os.remove(output_path_tmp)
-        else:
-            spritesheet.save(output_path)
+        replacing = os.path.exists(output_path)
+        if (
+            output_manifest.write_spritesheet(
+                spritesheet, output_path, self.build_profile["png_options"]
+            )
+            and replacing
+        ):
+            print("replacing", output_path)
+        render_cache.store(self.render_cache_key, output_path)
+
+    def add_cargo_label(self, label, x_offset, y_offset):
+        # labels are only for reading the generated spritesheets, so the build profile can leave them out
+        if self.build_profile["cargo_labels"]:
+            self.units.append(
+                AddCargoLabel(label=label, x_offset=x_offset, y_offset=y_offset)
+            )
 
     def render(self, consist):
         raise NotImplementedError("Implement me in %s" % repr(self))
@@ -182,6 +248,8 @@ class PassThroughPipeline(Pipeline):
     def render(self, consist, global_constants):
         self.units = []
         self.consist = consist
+        if self.restore_from_render_cache():
+            return
 
         input_image = Image.open(self.vehicle_source_input_path)
         self.render_common(input_image, self.units)
@@ -214,75 +282,97 @@ class GenerateSpritelayerCargoSets(Pipeline):
             + "_".join(result)
         )
 
+    def get_template_input_path(self, variant):
+        return os.path.join(
+            currentdir,
+            "src",
+            "graphics",
+            "cargo_templates",
+            self.resolve_template_name(variant) + ".png",
+        )
+
+    def get_cargo_item_input_path(self, cargo_item):
+        return os.path.join(
+            currentdir,
+            "src",
+            "polar_fox",
+            "graphics",
+            self.spritelayer_cargo.base_id,
+            cargo_item + ".png",
+        )
+
+    def get_render_cache_input_paths(self):
+        result = [self.spriterow_template_input_path]
+        for variant in self.spritelayer_cargo_set.variants:
+            result.append(self.get_template_input_path(variant))
+            for cargo_item in variant:
+                result.append(self.get_cargo_item_input_path(cargo_item))
+        return result
+
+    def get_render_cache_config(self):
+        # there's no consist here, the spritelayer cargo and cargo set provide the config
+        return [
+            self.__class__.__name__,
+            self.spritelayer_cargo.id,
+            self.spritelayer_cargo.floor_height_for_platform_type,
+            self.spritelayer_cargo.provide_container_shadows,
+            self.spritelayer_cargo.gestalt_graphics.cargo_sprites_are_asymmetric,
+            self.spritelayer_cargo_set.variants,
+        ]
+
     def add_cargo_spriterows(self):
         for variant in self.spritelayer_cargo_set.variants:
-            template_path = os.path.join(
-                currentdir,
-                "src",
-                "graphics",
-                "cargo_templates",
-                self.resolve_template_name(variant) + ".png",
-            )
-            template_image = Image.open(template_path)
+            template_path = self.get_template_input_path(variant)
+            template_image = asset_cache.get_image(template_path)
 
             # get the loc points and sort them for display
             # !! loc points might need extended to support double stack ??
-            loc_points = [
-                (pixel[0], pixel[1] - 10, pixel[2])
-                for pixel in pixa.pixascan(template_image)
-                if pixel[2] in [226, 240, 244]
-            ]
-            loc_points_grouped_and_sorted_for_display = {}
-            for angle_index, bbox in enumerate(
-                self.global_constants.spritesheet_bounding_boxes_asymmetric_unreversed
-            ):
-                pixels = []
-                for pixel in loc_points:
-                    if pixel[0] >= bbox[0] and pixel[0] <= (bbox[0] + bbox[1]):
-                        pixels.append(pixel)
-                        # catch invalid pixels
-                        if (1 + [226, 240, 244].index(pixel[2])) > len(variant):
-                            message = template_path
-                            message += (
-                                " contains pixel colour "
-                                + str(pixel[2])
-                                + " which implies "
-                                + str(1 + [226, 240, 244].index(pixel[2]))
-                                + " cargo sprites"
-                            )
-                            message += (
-                                " but the variant only defines "
-                                + str(len(variant))
-                                + " cargo sprite(s)"
-                            )
-                            raise ValueError(message)
-                # fake sprite sorter - cargo sprites nearer front need to overlap cargo sprites behind
-                # position pixel colour indexes (in the palette) must be in ascending order for left->right positions in <- view
-                # required index colours are 226, 240, 244
-                # the fake sprite sorter then just sorts ascending or descending as required for each angle
-                # !! double stack might be possible to handle just using this rudimentary sprite sorting ?? (or extending it??)
-                pixels = sorted(pixels, key=lambda pixel: pixel[2])
+            loc_point_index = pixa.LocPointIndex(
+                template_image,
+                colours=[226, 240, 244],
+                angle_x_starts=[
+                    bbox[0]
+                    for bbox in self.global_constants.spritesheet_bounding_boxes_asymmetric_unreversed
+                ],
+                y_offset=-10,
+            )
+            # fake sprite sorter - cargo sprites nearer front need to overlap cargo sprites behind
+            # position pixel colour indexes (in the palette) must be in ascending order for left->right positions in <- view
+            # required index colours are 226, 240, 244
+            # the fake sprite sorter then just sorts ascending or descending as required for each angle
+            # !! double stack might be possible to handle just using this rudimentary sprite sorting ?? (or extending it??)
+            loc_points_grouped_and_sorted_for_display = loc_point_index.get_loc_points_grouped_by_angle(
+                self.global_constants.spritesheet_bounding_boxes_asymmetric_unreversed,
+                colour_order=[226, 240, 244],
+            )
+            for (
+                angle_index,
+                pixels,
+            ) in loc_points_grouped_and_sorted_for_display.items():
+                for pixel in pixels:
+                    # catch invalid pixels
+                    if (1 + [226, 240, 244].index(pixel[2])) > len(variant):
+                        message = template_path
+                        message += (
+                            " contains pixel colour "
+                            + str(pixel[2])
+                            + " which implies "
+                            + str(1 + [226, 240, 244].index(pixel[2]))
+                            + " cargo sprites"
+                        )
+                        message += (
+                            " but the variant only defines "
+                            + str(len(variant))
+                            + " cargo sprite(s)"
+                        )
+                        raise ValueError(message)
                 if angle_index in [3, 4, 5]:
                     pixels.reverse()
-                loc_points_grouped_and_sorted_for_display[angle_index] = pixels
 
             # get all cargo sprites for this variant, and put them in a single structure
-            # n.b the implementation of this is likely inefficient as it will repetively open the same cargo sprites from the filesystem,
-            # but so far that seems to have negligible performance cost, and caching all cargo sprites earlier in the loop would add unwanted complexity
+            # the same cargo items are used by many variants, so the sliced sprites come from the asset cache
             cargos_for_this_variant = []
             for cargo_item in variant:
-                cargo_item_path = os.path.join(
-                    currentdir,
-                    "src",
-                    "polar_fox",
-                    "graphics",
-                    self.spritelayer_cargo.base_id,
-                    cargo_item + ".png",
-                )
-                cargo_item_image = Image.open(cargo_item_path)
-
-                # if self.spritelayer_cargo.id == 'intermodal_box_32px':
-                # cargo_item_image.show()
                 bboxes = []
                 # only a 3 tuple in global constants bounding box definitions (no y position), we need a 4 tuple inc. y position
                 # also the format of bounding boxes needs converted to PIL crop box format
@@ -291,9 +381,16 @@ class GenerateSpritelayerCargoSets(Pipeline):
                 ) in (
                     self.global_constants.spritesheet_bounding_boxes_asymmetric_unreversed
                 ):
-                    bboxes.append([bbox[0], 10, bbox[0] + bbox[1], 10 + bbox[2]])
-
-                cargo_sprites = pixa.get_arbitrary_angles(cargo_item_image, bboxes)
+                    bboxes.append((bbox[0], 10, bbox[0] + bbox[1], 10 + bbox[2]))
+
+                # copy the list, it's modified below for symmetric cargos, the sprites in it are shared and not modified
+                cargo_sprites = list(
+                    asset_cache.get_derived(
+                        self.get_cargo_item_input_path(cargo_item),
+                        ("arbitrary_angles", tuple(bboxes)),
+                        lambda image: pixa.get_arbitrary_angles(image, bboxes),
+                    )
+                )
                 if (
                     self.spritelayer_cargo.gestalt_graphics.cargo_sprites_are_asymmetric
                     == False
@@ -307,10 +404,9 @@ class GenerateSpritelayerCargoSets(Pipeline):
 
                 cargos_for_this_variant.append((cargo_item, cargo_sprites))
 
-            variant_output_image = Image.open(
-                os.path.join(currentdir, "src", "graphics", "spriterow_template.png")
-            )
-            variant_output_image = variant_output_image.copy().crop(
+            variant_output_image = asset_cache.get_image(
+                self.spriterow_template_input_path
+            ).crop(
                 (
                     0,
                     10,
@@ -419,13 +515,16 @@ class GenerateSpritelayerCargoSets(Pipeline):
             )
             self.units.append(AppendToSpritesheet(variant_spritesheet, crop_box_dest))
             variant_output_image.close()
-            template_image.close()
 
-    def render(self, spritelayer_cargo_set_pair, global_constants):
+    def render(self, cargo_set_render_plan, global_constants):
         self.units = []
-        self.spritelayer_cargo = spritelayer_cargo_set_pair[0]
-        self.spritelayer_cargo_set = spritelayer_cargo_set_pair[1]
+        self.spritelayer_cargo = cargo_set_render_plan.spritelayer_cargo
+        self.spritelayer_cargo_set = cargo_set_render_plan
         self.global_constants = global_constants
+        if self.restore_from_render_cache(
+            output_base_name=self.spritelayer_cargo_set.id
+        ):
+            return
 
         self.add_cargo_spriterows()
 
@@ -435,7 +534,7 @@ class GenerateSpritelayerCargoSets(Pipeline):
         self.render_common(
             input_image,
             self.units,
-            output_base_name=self.spritelayer_cargo_set.id(self.spritelayer_cargo),
+            output_base_name=self.spritelayer_cargo_set.id,
         )
 
 
@@ -451,6 +550,8 @@ class CheckBuyMenuOnlyPipeline(Pipeline):
     def render(self, consist, global_constants):
         self.units = []
         self.consist = consist
+        if self.restore_from_render_cache():
+            return
 
         if self.consist.buy_menu_x_loc == 360:
             # !! this currently will cause the vehicle spritesheet buy menu sprites to be copied to the pans spritesheet,
@@ -471,20 +572,43 @@ class GenerateBuyMenuSpritesheetFromRandomisationCandidatesPipeline(Pipeline):
         # this should be sparse, don't store any consist info in Pipelines, pass at render time
         super().__init__()
 
+    @property
+    def randomised_wagon_overlay_input_path(self):
+        return os.path.join(
+            currentdir, "src", "graphics", "randomised_wagon_overlay.png"
+        )
+
+    @property
+    def source_wagon_ids(self):
+        # sorted for a stable cache config, the candidate list is padded with repeats and is in arbitrary order otherwise
+        return sorted(set(self.consist.wagon_randomisation_candidate_ids))
+
+    def get_dependency_consist_ids(self, consist):
+        # the buy menu sprite is made from the generated spritesheets of the candidates
+        return consist.wagon_randomisation_candidate_ids
+
+    def get_render_cache_input_paths(self):
+        # note that we want the *generated* source wagon spritesheets
+        result = [
+            self.spriterow_template_input_path,
+            self.randomised_wagon_overlay_input_path,
+        ]
+        for source_wagon_id in self.source_wagon_ids:
+            result.append(self.get_output_path(source_wagon_id))
+        return result
+
+    def get_render_cache_config(self):
+        result = super().get_render_cache_config()
+        result.append(self.source_wagon_ids)
+        return result
+
     def process_buy_menu_sprite_from_randomisation_candidates(self, spritesheet):
         # this function is passed (uncalled) into the pipeline, and then called at render time
 
-        # take the first and last candidates;
-        # note that we have to call set here, due to the way random candidates are padded out to make power of 2 list lengths for random bits
-        # we have to use frozen_roster_items as the roster object won't pickle for multiprocessing use (never figured out why)
-        source_wagons = [
-            list(
-                set(self.consist.frozen_roster_items["wagon_randomisation_candidates"])
-            )[0],
-            list(
-                set(self.consist.frozen_roster_items["wagon_randomisation_candidates"])
-            )[1],
-        ]
+        # take the first two candidates;
+        # source_wagon_ids de-duplicates, due to the way random candidates are padded out to make power of 2 list lengths for random bits
+        # and it's sorted, so the sprite is built from the same candidates as the render cache key, not whatever order set() gives in this run
+        source_wagon_ids = self.source_wagon_ids[0:2]
         if len(self.consist.units) > 1:
             raise BaseException(
                 "GenerateBuyMenuSpritesheetFromRandomisationCandidatesPipeline won't work with articulated consists - called by "
@@ -492,13 +616,13 @@ class GenerateBuyMenuSpritesheetFromRandomisationCandidatesPipeline(Pipeline):
             )
         buy_menu_width_pixels = 4 * self.consist.units[0].vehicle_length
 
-        for counter, source_wagon in enumerate(source_wagons):
+        for counter, source_wagon_id in enumerate(source_wagon_ids):
             # note that we want the *generated* source wagon spritesheet
             source_wagon_input_path = os.path.join(
                 currentdir,
                 "generated",
                 "graphics",
-                source_wagon.id + ".png",
+                source_wagon_id + ".png",
             )
             source_wagon_image = Image.open(source_wagon_input_path)
             if self.consist.id == "randomised_box_car_pony_gen_1A":
@@ -525,12 +649,12 @@ class GenerateBuyMenuSpritesheetFromRandomisationCandidatesPipeline(Pipeline):
                 26,
             )
             custom_buy_menu_sprite = source_wagon_image.crop(crop_box_src)
-            spritesheet.sprites.paste(custom_buy_menu_sprite, crop_box_dest)
+            spritesheet.paste(custom_buy_menu_sprite, crop_box_dest)
 
         overlay_image_width = 16
         overlay_image_height = 16
-        overlay_image = Image.open(
-            os.path.join(currentdir, "src", "graphics", "randomised_wagon_overlay.png")
+        overlay_image = asset_cache.get_image(
+            self.randomised_wagon_overlay_input_path
         ).crop((10, 10, 10 + overlay_image_width, 10 + overlay_image_height))
         dice_recolour_maps = {
             1: {188: 9, 51: 12, 69: 15},
@@ -557,10 +681,10 @@ class GenerateBuyMenuSpritesheetFromRandomisationCandidatesPipeline(Pipeline):
             360 + x_offset + overlay_image_width,  # overlay image width
             10 + overlay_image_height,
         )
-        spritesheet.sprites.paste(overlay_image, crop_box_dest, overlay_mask)
+        spritesheet.paste(overlay_image, crop_box_dest, overlay_mask)
 
         if self.consist.id == "randomised_box_car_pony_gen_1A":
-            # spritesheet.sprites.show()
+            # spritesheet.crop((0, 0) + spritesheet.size).show()
             pass
 
         return spritesheet
@@ -568,19 +692,20 @@ class GenerateBuyMenuSpritesheetFromRandomisationCandidatesPipeline(Pipeline):
     def render(self, consist, global_constants):
         self.units = []
         self.consist = consist
+        if self.restore_from_render_cache():
+            return
 
         self.units.append(
             AddBuyMenuSprite(self.process_buy_menu_sprite_from_randomisation_candidates)
         )
 
-        empty_spriterow_image = Image.open(
-            os.path.join(currentdir, "src", "graphics", "spriterow_template.png")
+        empty_spriterow_image = asset_cache.get_image(
+            self.spriterow_template_input_path
         )
 
         # if self.consist.id == "randomised_box_car_pony_gen_1A":
         # empty_spriterow_image.show()
         self.render_common(empty_spriterow_image, self.units)
-        empty_spriterow_image.close()
 
 
 class GeneratePantographsSpritesheetPipeline(Pipeline):
@@ -590,23 +715,16 @@ class GeneratePantographsSpritesheetPipeline(Pipeline):
     Similar approach can be used for anything else provided in sprite layers.
     """
 
+    # writes a suffixed spritesheet, and reads the generated vehicle spritesheet for the debug rows
+    writes_vehicle_spritesheet = False
+    reads_vehicle_spritesheet = True
+
     def __init__(self):
         # this should be sparse, don't store any consist info in Pipelines, pass at render time
         super().__init__()
 
-    def add_pantograph_spriterows(self):
-        # !! this will eventually need extending for articulated vehicles
-        # !! that can be done by weaving in a repeat over units, to draw multiple pantograph blocks, using the same pattern as the vehicle Spritesheet
-        # !! the spriteset templates should then match the main vehicle, just changing path
-
-        # the gestalt can optionally tell us how many spriterows are needed, but if it doesn't, fallback to the unique spriterows
-        # we do it this way because the gestalt doesn't have easy access to the consist, so easier to do the fallback here
-        num_pantograph_rows = getattr(
-            self.consist.gestalt_graphics,
-            "num_pantograph_rows",
-            len(self.consist.unique_spriterow_nums),
-        )
-
+    @property
+    def pantograph_input_path(self):
         pantograph_input_images = {
             "diamond-single": "diamond.png",
             "diamond-double": "diamond.png",
@@ -616,14 +734,40 @@ class GeneratePantographsSpritesheetPipeline(Pipeline):
             "z-shaped-single-reversed": "z-shaped-reversed.png",
             "z-shaped-single-with-base": "z-shaped-with-base.png",
         }
-        pantograph_input_path = os.path.join(
+        return os.path.join(
             currentdir,
             "src",
             "graphics",
             "pantographs",
             pantograph_input_images[self.consist.pantograph_type],
         )
-        pantograph_input_image = Image.open(pantograph_input_path)
+
+    def get_render_cache_input_paths(self):
+        # the generated vehicle spritesheet is used for the debug rows
+        return [
+            self.vehicle_source_input_path,
+            self.pantograph_input_path,
+            self.spriterow_template_input_path,
+            self.get_output_path(),
+        ]
+
+    def get_render_cache_config(self):
+        result = super().get_render_cache_config()
+        result.append(self.consist.pantograph_type)
+        return result
+
+    def add_pantograph_spriterows(self):
+        # !! this will eventually need extending for articulated vehicles
+        # !! that can be done by weaving in a repeat over units, to draw multiple pantograph blocks, using the same pattern as the vehicle Spritesheet
+        # !! the spriteset templates should then match the main vehicle, just changing path
+
+        # the gestalt can optionally tell us how many spriterows are needed, but if it doesn't, fallback to the unique spriterows
+        # we do it this way because the gestalt doesn't have easy access to the consist, so easier to do the fallback here
+        num_pantograph_rows = getattr(
+            self.consist.gestalt_graphics,
+            "num_pantograph_rows",
+            len(self.consist.unique_spriterow_nums),
+        )
 
         bboxes = []
         # only a 3 tuple in global constants bounding box definitions (no y position), we need a 4 tuple inc. y position
@@ -632,9 +776,14 @@ class GeneratePantographsSpritesheetPipeline(Pipeline):
             for (
                 bbox
             ) in self.global_constants.spritesheet_bounding_boxes_asymmetric_unreversed:
-                bboxes.append([bbox[0], yoffset, bbox[0] + bbox[1], yoffset + bbox[2]])
+                bboxes.append((bbox[0], yoffset, bbox[0] + bbox[1], yoffset + bbox[2]))
 
-        pantograph_sprites = pixa.get_arbitrary_angles(pantograph_input_image, bboxes)
+        # pantograph sprites are the same for every consist with the same pantograph type, so they come from the asset cache
+        pantograph_sprites = asset_cache.get_derived(
+            self.pantograph_input_path,
+            ("arbitrary_angles", tuple(bboxes)),
+            lambda image: pixa.get_arbitrary_angles(image, bboxes),
+        )
         # needs to slice out A down, A up, B down, B up, depending on type
         # but B is probably just A reversed
         # so two spriterows is enough: down, up
@@ -699,27 +848,21 @@ class GeneratePantographsSpritesheetPipeline(Pipeline):
 
         vehicle_input_image = Image.open(self.vehicle_source_input_path)
         # get the loc points
-        loc_points = [
-            (pixel[0], pixel[1], pixel[2])
-            for pixel in pixa.pixascan(vehicle_input_image)
-            if pixel[2] == 226 or pixel[2] == 164
-        ]
         # loc points are in arbitrary row in source spritesheet but need to be moved up in output, so shift the y offset by the required amount
-        loc_points = [
-            (
-                pixel[0],
-                pixel[1] - (num_pantograph_rows * graphics_constants.spriterow_height),
-                pixel[2],
-            )
-            for pixel in loc_points
-        ]
         # sort them in y order, this causes sprites to overlap correctly when there are multiple loc points for an angle
-        loc_points = sorted(loc_points, key=lambda x: x[1])
+        loc_points = pixa.LocPointIndex(
+            vehicle_input_image,
+            colours=[226, 164],
+            angle_x_starts=[
+                bbox[0]
+                for bbox in self.global_constants.spritesheet_bounding_boxes_asymmetric_unreversed
+            ],
+            y_offset=-1 * num_pantograph_rows * graphics_constants.spriterow_height,
+        ).get_loc_points_sorted_by_y()
 
-        empty_spriterow_image = Image.open(
-            os.path.join(currentdir, "src", "graphics", "spriterow_template.png")
-        )
-        empty_spriterow_image = empty_spriterow_image.crop(
+        empty_spriterow_image = asset_cache.get_image(
+            self.spriterow_template_input_path
+        ).crop(
             (
                 0,
                 10,
@@ -749,13 +892,7 @@ class GeneratePantographsSpritesheetPipeline(Pipeline):
             self.pantograph_state
         ]
         for pixel in loc_points:
-            angle_num = 0
-            for counter, bbox in enumerate(
-                self.global_constants.spritesheet_bounding_boxes_asymmetric_unreversed
-            ):
-                if pixel[0] >= bbox[0]:
-                    angle_num = counter
-            pantograph_sprite_num = angle_num
+            pantograph_sprite_num = pixel[3]
 
             pantograph_width = pantograph_sprites[pantograph_sprite_num][0].size[0]
             pantograph_height = pantograph_sprites[pantograph_sprite_num][0].size[1]
@@ -780,10 +917,8 @@ class GeneratePantographsSpritesheetPipeline(Pipeline):
             )
 
         # add debug sprites with vehicle-pantograph comp for ease of checking
-        # this very much assumes that the vehicle image has been generated, which holds currently due to the order pipelines are run in (and are in series)
-        vehicle_debug_image = Image.open(
-            os.path.join(currentdir, "generated", "graphics", self.consist.id + ".png")
-        )
+        # this very much assumes that the vehicle image has been generated, which holds as reads_vehicle_spritesheet schedules this pipeline after the vehicle pipeline
+        vehicle_debug_image = Image.open(self.get_output_path())
         vehicle_debug_image = vehicle_debug_image.copy().crop(
             (
                 0,
@@ -827,7 +962,6 @@ class GeneratePantographsSpritesheetPipeline(Pipeline):
             10 + (2 * num_pantograph_rows * graphics_constants.spriterow_height),
         )
         self.units.append(AppendToSpritesheet(pantograph_spritesheet, crop_box_dest))
-        pantograph_input_image.close()
         vehicle_input_image.close()
         empty_spriterow_image.close()
 
@@ -835,17 +969,19 @@ class GeneratePantographsSpritesheetPipeline(Pipeline):
         self.units = []
         self.consist = consist
         self.global_constants = global_constants
+        # this will render a spritesheet with an additional suffix, separate from the vehicle spritesheet
+        output_suffix = "_pantographs_" + self.pantograph_state
+        if self.restore_from_render_cache(output_suffix=output_suffix):
+            return
 
         self.add_pantograph_spriterows()
 
         if self.consist.buy_menu_x_loc == 360:
             self.units.append(AddBuyMenuSprite(self.process_buy_menu_sprite))
 
-        # this will render a spritesheet with an additional suffix, separate from the vehicle spritesheet
         input_image = Image.open(self.vehicle_source_input_path).crop(
             (0, 0, graphics_constants.spritesheet_width, 10)
         )
-        output_suffix = "_pantographs_" + self.pantograph_state
         self.render_common(input_image, self.units, output_suffix=output_suffix)
         input_image.close()
 
@@ -891,6 +1027,66 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
         # initing things here is proven to have unexpected results, as the processor will be shared across multiple vehicles
         super().__init__()
 
+    @property
+    def box_car_input_path(self):
+        # all wagons using this gestalt repaint the relevant base sprite for the wagon's generation and subtype
+        # the id is derived when the render plan is compiled
+        return os.path.join(
+            currentdir,
+            "src",
+            "graphics",
+            self.consist.roster_id,
+            self.consist.box_car_id,
+        )
+
+    def get_render_cache_input_paths(self):
+        result = [self.vehicle_source_input_path, self.spriterow_template_input_path]
+        for unit in self.consist.unique_units:
+            # same hax as render(), so the path properties can be reused
+            self.vehicle_unit = unit
+            if self.vehicle_unit.chassis is not None:
+                result.append(self.chassis_input_path)
+            if (
+                self.vehicle_unit.roof is not None
+                and not self.vehicle_unit.suppress_roof_sprite
+            ):
+                result.append(self.roof_input_path)
+            self.vehicle_unit = None
+        if getattr(self.consist.gestalt_graphics, "has_piece", False):
+            for (
+                cargo_filename
+            ) in polar_fox.constants.piece_vehicle_type_to_sprites_maps[
+                self.consist.gestalt_graphics.piece_type
+            ]:
+                result.append(
+                    os.path.join(
+                        currentdir,
+                        "src",
+                        "polar_fox",
+                        "graphics",
+                        "piece_cargos",
+                        cargo_filename + ".png",
+                    )
+                )
+        if (
+            "box_car_with_opening_doors_spriterows"
+            in self.consist.gestalt_graphics.get_output_row_types()
+        ):
+            result.append(self.box_car_input_path)
+        return result
+
+    def get_render_cache_config(self):
+        result = super().get_render_cache_config()
+        # box cars pick their base sprite by these, and gen can be derived from the roster intro dates, which aren't otherwise hashed
+        result.append(
+            (
+                self.consist.base_track_type,
+                self.consist.gen,
+                getattr(self.consist, "subtype", None),
+            )
+        )
+        return result
+
     def get_spriterow_types_for_consist(self):
         # builds a map of spriterows for the entire consist by walking gestalt graphics for each unique unit
         # might be that this should be handled via the gestalt graphics class, but potato / potato here I think
@@ -902,27 +1098,26 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
             result.append(unit_rows)
         return result
 
-    def comp_chassis_and_body(self, body_image):
+    def make_chassis_layer(self, input_images):
+        # chassis, with roof composited and columns mirrored as needed, ready for the body to be pasted on
+        # this doesn't vary per row, so it's cached via comp_chassis_and_body, and shared by all consists with the same chassis, roof and symmetry
         crop_box_input_1 = (
             0,
             10,
             self.sprites_max_x_extent,
             10 + graphics_constants.spriterow_height,
         )
-        chassis_image = Image.open(self.chassis_input_path).crop(crop_box_input_1)
+        chassis_image = input_images[0].crop(crop_box_input_1)
 
         # roof is composited (N.B. gangways are not, just draw them in vehicle sprite, handling asymmetric railcar cases would be one step too far on automation)
-        if (
-            self.vehicle_unit.roof is not None
-            and not self.vehicle_unit.suppress_roof_sprite
-        ):
+        if len(input_images) > 1:
             crop_box_roof_dest = (
                 0,
                 0,
                 self.sprites_max_x_extent,
                 graphics_constants.spriterow_height,
             )
-            roof_image = Image.open(self.roof_input_path).crop(crop_box_input_1)
+            roof_image = input_images[1].crop(crop_box_input_1)
 
             # the roof image has false colour pixels to aid drawing; remove these by converting to white, also convert any blue to white
             roof_image = roof_image.point(lambda i: 255 if i == 226 else i)
@@ -946,7 +1141,7 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
                 self.sprites_max_x_extent,
                 0 + graphics_constants.spriterow_height,
             )
-            chassis_image_2 = chassis_image.copy().crop(crop_box_input_2)
+            chassis_image_2 = chassis_image.crop(crop_box_input_2)
 
             crop_box_input_2_dest = (
                 self.global_constants.spritesheet_bounding_boxes_asymmetric_unreversed[
@@ -960,16 +1155,32 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
                 0 + graphics_constants.spriterow_height,
             )
             chassis_image.paste(chassis_image_2, crop_box_input_2_dest)
+        return chassis_image
+
+    def comp_chassis_and_body(self, body_image):
+        chassis_layer_input_paths = [self.chassis_input_path]
+        if (
+            self.vehicle_unit.roof is not None
+            and not self.vehicle_unit.suppress_roof_sprite
+        ):
+            chassis_layer_input_paths.append(self.roof_input_path)
+        # copy the cached chassis layer, as the body is pasted into it
+        chassis_image = asset_cache.get_composite(
+            chassis_layer_input_paths,
+            (
+                "chassis_layer",
+                self.vehicle_unit.symmetry_type,
+                self.sprites_max_x_extent,
+            ),
+            self.make_chassis_layer,
+        ).copy()
 
         # the body image has false colour pixels for the chassis, to aid drawing; remove these by converting to white, also convert any blue to white
-        body_image = body_image.point(
-            lambda i: 255 if (i in range(178, 192) or i == 0) else i
-        )
+        body_image = body_image.point(body_false_colour_table)
         # body_image.show()
 
         # create a mask so that we paste only the vehicle pixels over the chassis (no blue pixels)
-        body_mask = body_image.copy()
-        body_mask = body_mask.point(lambda i: 0 if i == 255 else 255).convert(
+        body_mask = body_image.point(body_mask_table).convert(
             "1"
         )  # the inversion here of blue and white looks a bit odd, but potato / potato
 
@@ -997,10 +1208,9 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
             self.vehicle_source_image.copy().crop(crop_box_source)
         )
         # vehicle_generic_spriterow_input_image.show() # comment in to see the image when debugging
-        empty_spriterow_image = Image.open(
-            os.path.join(currentdir, "src", "graphics", "spriterow_template.png")
-        )
-        empty_spriterow_image = empty_spriterow_image.crop(
+        empty_spriterow_image = asset_cache.get_image(
+            self.spriterow_template_input_path
+        ).crop(
             (
                 0,
                 10,
@@ -1074,12 +1284,10 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
             )
             if variant["body_recolour_map"] is not None:
                 self.units.append(SimpleRecolour(variant["body_recolour_map"]))
-            self.units.append(
-                AddCargoLabel(
-                    label=variant["label"],
-                    x_offset=self.sprites_max_x_extent + 5,
-                    y_offset=-1 * graphics_constants.spriterow_height,
-                )
+            self.add_cargo_label(
+                label=variant["label"],
+                x_offset=self.sprites_max_x_extent + 5,
+                y_offset=-1 * graphics_constants.spriterow_height,
             )
 
     def add_livery_spriterows(self):
@@ -1121,12 +1329,10 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
                     )
                 )
                 self.units.append(SimpleRecolour(recolour_map))
-                self.units.append(
-                    AddCargoLabel(
-                        label=label,
-                        x_offset=self.sprites_max_x_extent + 5,
-                        y_offset=-1 * graphics_constants.spriterow_height,
-                    )
+                self.add_cargo_label(
+                    label=label,
+                    x_offset=self.sprites_max_x_extent + 5,
+                    y_offset=-1 * graphics_constants.spriterow_height,
                 )
 
     def add_pax_mail_car_with_opening_doors_spriterows(self, row_count):
@@ -1245,19 +1451,7 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
             )
 
     def add_box_car_with_opening_doors_spriterows(self):
-        # all wagons using this gestalt repaint the relevant base sprite for the wagon's generation and subtype
-        id_base = self.consist.gestalt_graphics.id_base
-        if self.consist.base_track_type == "NG":
-            id_base = id_base + "_ng"
-        box_car_id = self.consist.get_wagon_id(
-            id_base=id_base,
-            roster_id=self.consist.roster_id,
-            gen=self.consist.gen,
-            subtype=self.consist.subtype + ".png",
-        )
-        box_car_input_path = os.path.join(
-            currentdir, "src", "graphics", self.consist.roster_id, box_car_id
-        )
+        box_car_input_path = self.box_car_input_path
 
         # two spriterows, closed doors and open doors
         crop_box_source_1 = (
@@ -1273,10 +1467,10 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
             self.base_yoffs + 2 * graphics_constants.spriterow_height,
         )
         box_car_input_image_1 = self.comp_chassis_and_body(
-            Image.open(box_car_input_path).crop(crop_box_source_1)
+            asset_cache.get_image(box_car_input_path).crop(crop_box_source_1)
         )
         box_car_input_image_2 = self.comp_chassis_and_body(
-            Image.open(box_car_input_path).crop(crop_box_source_2)
+            asset_cache.get_image(box_car_input_path).crop(crop_box_source_2)
         )
         # if self.consist.id == 'box_car_pony_gen_1A':
         # box_car_input_image_1.show() # comment in to see the image when debugging
@@ -1484,12 +1678,10 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
             )
             self.units.append(SimpleRecolour(body_recolour_map))
             self.units.append(SimpleRecolour(cargo_recolour_map))
-            self.units.append(
-                AddCargoLabel(
-                    label=label,
-                    x_offset=self.sprites_max_x_extent + 5,
-                    y_offset=-1 * cargo_group_row_height,
-                )
+            self.add_cargo_label(
+                label=label,
+                x_offset=self.sprites_max_x_extent + 5,
+                y_offset=-1 * cargo_group_row_height,
             )
 
     def add_piece_cargo_spriterows(self):
@@ -1515,15 +1707,20 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
             crop_box_vehicle_cargo_loc_row
         )
         # get the loc points
-        loc_points = [
-            (pixel[0] + self.second_col_start_x, pixel[1], pixel[2])
-            for pixel in pixa.pixascan(vehicle_cargo_loc_image)
-            if pixel[2] == 226
-        ]
-        # two cargo rows needed, so extend the loc points list
-        loc_points.extend([(pixel[0], pixel[1] + 30, pixel[2]) for pixel in loc_points])
         # sort them in y order, this causes sprites to overlap correctly when there are multiple loc points for an angle
-        loc_points = sorted(loc_points, key=lambda x: x[1])
+        loc_points = pixa.LocPointIndex(
+            vehicle_cargo_loc_image,
+            colours=[226],
+            angle_x_starts=[
+                bbox[0]
+                for bbox in self.global_constants.spritesheet_bounding_boxes_asymmetric_unreversed
+            ],
+            x_offset=self.second_col_start_x,
+        ).get_loc_points_sorted_by_y()
+        # two cargo rows needed, so extend the loc points list; the second row is all below the first so it stays sorted
+        loc_points.extend(
+            [(pixel[0], pixel[1] + 30, pixel[2], pixel[3]) for pixel in loc_points]
+        )
 
         # this is dirty shorthand and relies on has_cover yielding 0 or 1 for an additional offset (empty row is second row if has_cover is True)
         empty_row_yoffs = self.cur_vehicle_empty_row_yoffs + (
@@ -1591,7 +1788,7 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
         # piece_cargo_rows_image.show()
         crop_box_dest = (0, 0, self.sprites_max_x_extent, cargo_group_output_row_height)
 
-        piece_cargo_sprites = PieceCargoSprites(
+        piece_cargo_sprites = pixa.get_piece_cargo_sprites(
             polar_fox_constants=polar_fox.constants,
             polar_fox_graphics_path=os.path.join("src", "polar_fox", "graphics"),
         )
@@ -1606,12 +1803,7 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
             vehicle_comped_image = piece_cargo_rows_image.copy()
 
             for pixel in loc_points:
-                angle_num = 0
-                for counter, bbox in enumerate(
-                    self.global_constants.spritesheet_bounding_boxes_asymmetric_unreversed
-                ):
-                    if pixel[0] >= bbox[0]:
-                        angle_num = counter
+                angle_num = pixel[3]
                 # clamp angle_num to 4, cargo sprites are symmetrical, only 4 angles provided
                 if angle_num > 3:
                     angle_num = angle_num % 4
@@ -1658,12 +1850,10 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
                 AppendToSpritesheet(vehicle_comped_image_as_spritesheet, crop_box_dest)
             )
             self.units.append(SimpleRecolour(body_recolour_map))
-            self.units.append(
-                AddCargoLabel(
-                    label=cargo_filename,
-                    x_offset=self.sprites_max_x_extent + 5,
-                    y_offset=-1 * cargo_group_output_row_height,
-                )
+            self.add_cargo_label(
+                label=cargo_filename,
+                x_offset=self.sprites_max_x_extent + 5,
+                y_offset=-1 * cargo_group_output_row_height,
             )
 
     def render(self, consist, global_constants):
@@ -1680,6 +1870,8 @@ class ExtendSpriterowsForCompositedSpritesPipeline(Pipeline):
             self.global_constants.spritesheet_bounding_boxes_asymmetric_unreversed[4][0]
         )
         self.col_image_width = self.sprites_max_x_extent - self.second_col_start_x
+        if self.restore_from_render_cache():
+            return
 
         self.vehicle_source_image = Image.open(self.vehicle_source_input_path)
 
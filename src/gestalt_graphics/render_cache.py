@@ -0,0 +1,99 @@
+import os.path
+
+currentdir = os.curdir
+
+import filecmp
+import hashlib
+import shutil
+
+import global_constants
+
+# the graphics code itself is an input to every spritesheet, so changing any of these files invalidates the whole cache
+# this is cruder than tracking exactly which code each pipeline uses, but it's reliable, and code changes are rare compared to sprite edits
+pipeline_code_paths = [
+    os.path.join(currentdir, "src", "global_constants.py"),
+    os.path.join(currentdir, "src", "gestalt_graphics", "asset_cache.py"),
+    os.path.join(currentdir, "src", "gestalt_graphics", "gestalt_graphics.py"),
+    os.path.join(currentdir, "src", "gestalt_graphics", "graphics_constants.py"),
+    os.path.join(currentdir, "src", "gestalt_graphics", "pipelines.py"),
+    os.path.join(currentdir, "src", "gestalt_graphics", "render_cache.py"),
+    os.path.join(currentdir, "src", "gestalt_graphics", "render_plan.py"),
+    os.path.join(currentdir, "src", "polar_fox", "constants.py"),
+    os.path.join(currentdir, "src", "polar_fox", "graphics_units.py"),
+    os.path.join(currentdir, "src", "polar_fox", "pixa.py"),
+]
+
+# file digests are memoised per process, as the same chassis, roofs and templates are read by many consists
+# keyed on mtime and size as well as path, as some inputs are generated spritesheets which can change during a run
+file_digests = {}
+
+
+def get_file_digest(path):
+    if not os.path.exists(path):
+        # let the pipeline fail on the missing file, the cache doesn't need to care
+        return "missing"
+    stat = os.stat(path)
+    digest_key = (path, stat.st_mtime_ns, stat.st_size)
+    if digest_key not in file_digests:
+        with open(path, "rb") as input_file:
+            file_digests[digest_key] = hashlib.sha256(input_file.read()).hexdigest()
+    return file_digests[digest_key]
+
+
+def get_pipeline_code_version():
+    hasher = hashlib.sha256()
+    for path in pipeline_code_paths:
+        hasher.update(get_file_digest(path).encode())
+    return hasher.hexdigest()
+
+
+class RenderCache(object):
+    """
+    Persistent content-addressed store of rendered spritesheets.
+    Spritesheets are keyed by a hash of every input that went into them, so unchanged consists can skip all pipeline work.
+    """
+
+    def __init__(self):
+        self.cache_path = os.path.join(currentdir, global_constants.graphics_cache_dir)
+
+    def get_key(self, input_paths, config):
+        # config must have a stable repr (no object addresses), so stick to strings, numbers, and containers of them
+        hasher = hashlib.sha256()
+        hasher.update(get_pipeline_code_version().encode())
+        for input_path in input_paths:
+            hasher.update(input_path.encode())
+            hasher.update(get_file_digest(input_path).encode())
+        hasher.update(repr(config).encode())
+        return hasher.hexdigest()
+
+    def get_cached_spritesheet_path(self, key):
+        return os.path.join(self.cache_path, key + ".png")
+
+    def copy_atomic(self, source_path, dest_path):
+        # copy to a tmp file then rename, so other pool workers never see a partially written file
+        dest_path_tmp = dest_path + "." + str(os.getpid()) + ".tmp"
+        shutil.copyfile(source_path, dest_path_tmp)
+        os.replace(dest_path_tmp, dest_path)
+
+    def restore(self, key, output_path):
+        # returns True on a hit, in which case output_path is guaranteed to hold the cached spritesheet
+        cached_spritesheet_path = self.get_cached_spritesheet_path(key)
+        if not os.path.exists(cached_spritesheet_path):
+            return False
+        # don't replace unchanged files, it destroys the nmlc sprite cache
+        if os.path.exists(output_path):
+            if not filecmp.cmp(output_path, cached_spritesheet_path):
+                print("replacing", output_path)
+                self.copy_atomic(cached_spritesheet_path, output_path)
+        else:
+            self.copy_atomic(cached_spritesheet_path, output_path)
+        return True
+
+    def store(self, key, output_path):
+        if not os.path.exists(self.cache_path):
+            os.makedirs(self.cache_path, exist_ok=True)
+        self.copy_atomic(output_path, self.get_cached_spritesheet_path(key))
+
+
+# one instance per process is enough, it holds no state beyond the path
+render_cache = RenderCache()
@@ -0,0 +1,147 @@
+import hashlib
+
+import global_constants
+from gestalt_graphics.asset_cache import asset_cache
+from gestalt_graphics.dependency_manifest import dependency_manifest
+from gestalt_graphics.output_manifest import output_manifest
+
+# render plans are compiled from the roster model in the main process, and are all the graphics pipelines get to see
+# they copy the consist, unit and spritelayer cargo properties pipelines read, and resolve anything needing the roster, so workers never need consists or rosters
+# they are not a full lowering to input paths, crop boxes and recolour maps: the gestalt is carried as-is, with its pipeline instances, and the pipelines still do that work in the worker
+# so workers do still need the gestalt_graphics and pipelines modules, but nothing from the roster model
+# the attribute names match the consist / unit / spritelayer cargo properties that pipelines use, so pipelines don't care which they're given
+
+
+def get_config(value):
+    # plans hold gestalts and other plans, which have no stable repr, so swap them for their config, to get a digest that's stable across runs
+    if isinstance(value, (list, tuple)):
+        return [get_config(item) for item in value]
+    if isinstance(value, dict):
+        return sorted((key, get_config(item)) for key, item in value.items())
+    if hasattr(value, "get_render_config"):
+        # gestalts list their own config fields, pipelines are found from the gestalt and pipeline index, and have no config of their own
+        return get_config(value.get_render_config())
+    if hasattr(value, "__dict__"):
+        # other render plans, which are just attributes
+        return [value.__class__.__name__, get_config(vars(value))]
+    return value
+
+
+def get_digest(render_plan):
+    # changes whenever anything a pipeline takes from the vehicle modules changes
+    return hashlib.sha256(repr(get_config(render_plan)).encode()).hexdigest()
+
+
+class UnitRenderPlan(object):
+    """Copy of the unit properties used by graphics pipelines."""
+
+    def __init__(self, unit):
+        self.vehicle_length = unit.vehicle_length
+        self.spriterow_num = unit.spriterow_num
+        self.chassis = unit.chassis
+        self.roof = unit.roof
+        self.suppress_roof_sprite = unit.suppress_roof_sprite
+        self.symmetry_type = unit.symmetry_type
+
+
+class ConsistRenderPlan(object):
+    """
+    Description of one consist pipeline, compiled from the consist by the main process, holding copies of the consist properties and the consist's gestalt.
+    Anything that needs the roster (e.g. randomisation candidates) is resolved here, so it doesn't need freezing on the consist.
+    """
+
+    def __init__(self, consist, pipeline_index, build_profile):
+        self.id = consist.id
+        self.roster_id = consist.roster_id
+        self.base_track_type = consist.base_track_type
+        self.gen = consist.gen
+        # only wagons have a subtype
+        self.subtype = getattr(consist, "subtype", None)
+        self.buy_menu_x_loc = consist.buy_menu_x_loc
+        self.pantograph_type = consist.pantograph_type
+        # the gestalt is referenced, not copied, it pickles with its pipeline instances, and the pipeline to run is found from it
+        self.gestalt_graphics = consist.gestalt_graphics
+        self.pipeline_index = pipeline_index
+        # from the makefile args, compiled into the plan so pipelines never need to parse them
+        self.build_profile = build_profile
+        # units are repeated in some consists, keep that, but only make one plan per unit
+        unit_plans = {}
+        self.units = []
+        for unit in consist.units:
+            if id(unit) not in unit_plans:
+                unit_plans[id(unit)] = UnitRenderPlan(unit)
+            self.units.append(unit_plans[id(unit)])
+        self.unique_units = list(unit_plans.values())
+        self.unique_spriterow_nums = consist.unique_spriterow_nums
+        if self.gestalt_graphics.__class__.__name__ == "GestaltGraphicsRandomisedWagon":
+            self.wagon_randomisation_candidate_ids = [
+                candidate.id
+                for candidate in consist.roster.get_wagon_randomisation_candidates(
+                    consist
+                )
+            ]
+        if getattr(self.gestalt_graphics, "id_base", None) is not None:
+            # box car sprites are picked by gen and subtype, the id is derived by the consist
+            id_base = self.gestalt_graphics.id_base
+            if self.base_track_type == "NG":
+                id_base = id_base + "_ng"
+            self.box_car_id = consist.get_wagon_id(
+                id_base=id_base,
+                roster_id=self.roster_id,
+                gen=self.gen,
+                subtype=self.subtype + ".png",
+            )
+
+    @property
+    def pipeline(self):
+        return self.gestalt_graphics.pipelines[self.pipeline_index]
+
+
+class SpritelayerCargoRenderPlan(object):
+    """Copy of the spritelayer cargo properties used by graphics pipelines, plus the spritelayer cargo gestalt."""
+
+    def __init__(self, spritelayer_cargo):
+        self.id = spritelayer_cargo.id
+        self.base_id = spritelayer_cargo.base_id
+        self.length = spritelayer_cargo.length
+        self.floor_height_for_platform_type = (
+            spritelayer_cargo.floor_height_for_platform_type
+        )
+        self.provide_container_shadows = spritelayer_cargo.provide_container_shadows
+        self.gestalt_graphics = spritelayer_cargo.gestalt_graphics
+
+
+class CargoSetRenderPlan(object):
+    """
+    Description of one spritelayer cargo set pipeline, compiled by the main process.
+    Cargo sets are shared across spritelayer cargos, so the id is resolved here for the specific spritelayer cargo.
+    """
+
+    def __init__(self, spritelayer_cargo, cargo_set, pipeline_index, build_profile):
+        self.spritelayer_cargo = SpritelayerCargoRenderPlan(spritelayer_cargo)
+        self.id = cargo_set.id(spritelayer_cargo)
+        self.graphics_template_subtype_name = cargo_set.graphics_template_subtype_name
+        self.variants = cargo_set.variants
+        self.pipeline_index = pipeline_index
+        self.build_profile = build_profile
+
+    @property
+    def pipeline(self):
+        return self.spritelayer_cargo.gestalt_graphics.spritelayer_cargo_pipelines[
+            self.pipeline_index
+        ]
+
+
+def run_render_plan(render_plan):
+    # runs in the worker process, only needs the plan, and the graphics modules
+    pipeline = render_plan.pipeline
+    # pipelines keep per-render state on themselves, as they do with the consist they're given
+    pipeline.build_profile = render_plan.build_profile
+    pipeline.render(render_plan, global_constants)
+    # the asset cache and manifests are module-level, so each pool worker has its own
+    # what this plan added to them is popped and returned, for the main process to merge
+    return (
+        asset_cache.pop_stats(),
+        output_manifest.pop_updates(),
+        dependency_manifest.pop_records(),
+    )
@@ -413,6 +413,26 @@ sprites_max_x_extent = (
     + spritesheet_bounding_boxes_asymmetric_unreversed[7][1]
 )
 
+# persistent store of rendered spritesheets, so unchanged consists can skip graphics processing (removed by make clean)
+graphics_cache_dir = ".graphics_cache"
+
+# build profiles, set with PROFILE=dev or PROFILE=release in the makefile, release is the default
+# generated pngs are read straight back by grfcodec, so dev builds don't spend time on compressing them hard
+# png_options are passed to PIL when saving pngs, see the PIL docs for the png format
+# cargo labels are only there for reading the generated spritesheets, they're not used in game
+build_profiles = {
+    "dev": {
+        "png_options": {"compress_level": 1},
+        "docs_images": False,
+        "cargo_labels": False,
+    },
+    "release": {
+        "png_options": {"optimize": True},
+        "docs_images": True,
+        "cargo_labels": True,
+    },
+}
+
 # shared global constants via Polar Fox library - import at end to make the this project's constants easier to work with
 # done this way so we don't have to pass Polar Fox to templates, we can just pass global_constants
 # assignments are clunky - they exist to stop pyflakes tripping on 'unused' imports
@@ -3,9 +3,15 @@ import os.path
 currentdir = os.curdir
 
 import sys
+import glob
+import hashlib
+import importlib
+import pickle
+from functools import cached_property
 
 sys.path.append(os.path.join("src"))  # add to the module search path
 
+import depfiles
 import global_constants
 import utils
 
@@ -15,126 +21,29 @@ generated_files_path = os.path.join(currentdir, global_constants.generated_files
 if not os.path.exists(generated_files_path):
     os.mkdir(generated_files_path)
 
-# this format of import is weird, but I don't want the imported modules directly in the iron horse namespace, I want to nest in spritelayer_cargos
-from spritelayer_cargos import registered_spritelayer_cargos
-from spritelayer_cargos import intermodal_containers
-
-from spritelayer_cargos import automobiles
+model_snapshot_path = os.path.join(generated_files_path, "model_snapshot.pickle")
+# main() only needs to do anything once per process
+model_registered = False
+# names of the modules imported to register the model, kept in the snapshot
+model_module_names = []
 
-# import railtypes
+# registries populated by registering the model, see main()
+from spritelayer_cargos import registered_spritelayer_cargos
 from railtypes import registered_railtypes
-from railtypes import metro
-from railtypes import narrow_gauge
-from railtypes import lgv
-from railtypes import lgv_electrified
-
-# import rosters
 from rosters import registered_rosters
-from rosters import pony
-
-from vehicles import numeric_id_defender
-
-# import wagons
-from vehicles import acid_tank_cars
-from vehicles import aggregate_cars
-
-# from vehicles import alignment_cars
-from vehicles import automobile_cars
-from vehicles import bolster_cars
-from vehicles import box_cars
-from vehicles import bulkhead_flat_cars
-from vehicles import caboose_cars
-from vehicles import goods_caboose_cars
-from vehicles import carbon_black_hopper_cars
-from vehicles import cement_silo_cars
-from vehicles import chemical_covered_hopper_cars
-from vehicles import coil_buggy_cars
-from vehicles import coil_cars_covered
-from vehicles import coil_cars_uncovered
-from vehicles import covered_hopper_cars
-from vehicles import cryo_tank_cars
-from vehicles import curtain_side_box_cars
-from vehicles import double_deck_automobile_cars
-from vehicles import dry_powder_hopper_cars
-from vehicles import dump_cars
-from vehicles import dump_cars_high_side
-from vehicles import edibles_tank_cars
-from vehicles import express_cars
-from vehicles import express_intermodal_cars
-from vehicles import express_railcar_passenger_trailer_cars
-from vehicles import farm_products_box_cars
-from vehicles import farm_products_hopper_cars
-from vehicles import flat_cars
-from vehicles import goods_box_cars
-from vehicles import hood_open_cars
-from vehicles import hopper_cars
-from vehicles import hst_mail_cars
-from vehicles import hst_passenger_cars
-from vehicles import ingot_cars
-from vehicles import intermodal_cars
-from vehicles import kaolin_hopper_cars
-from vehicles import livestock_cars
-from vehicles import log_cars
-from vehicles import low_floor_automobile_cars
-from vehicles import low_floor_intermodal_cars
-from vehicles import mail_cars
-from vehicles import merchandise_box_cars
-from vehicles import merchandise_open_cars
-from vehicles import mineral_covered_hopper_cars
-from vehicles import mineral_hopper_cars
-from vehicles import mgr_hopper_cars
-from vehicles import open_cars
-from vehicles import ore_dump_cars
-from vehicles import ore_hopper_cars
-from vehicles import passenger_cars
-from vehicles import peat_cars
-from vehicles import plate_cars
-from vehicles import pressure_tank_cars
-from vehicles import product_tank_cars
-from vehicles import railbus_passenger_trailer_cars
-from vehicles import railcar_passenger_trailer_cars
-from vehicles import randomised_box_cars
-from vehicles import randomised_bulk_cars
-from vehicles import randomised_cold_metal_cars
-from vehicles import randomised_dump_cars
-from vehicles import randomised_flat_cars
-from vehicles import randomised_hopper_cars
-from vehicles import randomised_open_cars
-from vehicles import randomised_piece_goods_cars
-from vehicles import randomised_chemicals_tank_cars
-from vehicles import reefer_cars
-from vehicles import restaurant_cars
-from vehicles import rock_hopper_cars
-from vehicles import roller_roof_hopper_cars
-from vehicles import scrap_metal_cars
-from vehicles import silo_cars
-from vehicles import skip_cars
-from vehicles import slag_ladle_cars
-from vehicles import sliding_roof_cars
-from vehicles import sliding_wall_cars
-from vehicles import suburban_passenger_cars
-from vehicles import swing_roof_hopper_cars
-from vehicles import tank_cars
-from vehicles import tarpaulin_cars
-from vehicles import torpedo_cars
-from vehicles import vehicle_parts_box_cars
+from vehicles import numeric_id_registry
 
 
 def vacant_numeric_ids_formatted():
     # when adding vehicles it's useful to know what the next free numeric ID is
     # tidy-mind problem, but do we have any vacant numeric ID slots in the currently used range?
     # 'print' eh? - but it's fine echo_message isn't intended for this kind of info, don't bother changing
-    max_id = max(numeric_id_defender) - (max(numeric_id_defender) % 10)
-    id_gaps = []
-    for i in range(0, int(max_id / 10)):
-        id = i * 10
-        if id not in numeric_id_defender:
-            id_gaps.append(str(id))
+    vacant_slots, first_free_slot = numeric_id_registry.get_vacant_slots(10)
     return (
         "Vacant numeric ID slots: "
-        + ", ".join(id_gaps)
-        + (" and from " if len(id_gaps) > 0 else "")
-        + str(max_id + 10)
+        + ", ".join([str(slot) for slot in vacant_slots])
+        + (" and from " if len(vacant_slots) > 0 else "")
+        + str(first_free_slot)
         + " onwards"
     )
 
@@ -152,6 +61,8 @@ class ActiveRosters(list):
     Sometimes we want to conveniently expose attributes that span active rosters.
     This is a class to manage that, intended for use as a singleton, which can be passed to templates etc.
     Extends default python list, as we also use it when we want a list of active rosters (the instantiated class instance behaves like a list object).
+    Get the instance with get_active_rosters(), not by instantiating directly; derived lists are computed once and cached on the instance.
+    That means it must not be created until all rosters, consists etc are registered, i.e. after iron_horse.main().
     """
 
     def __init__(self):
@@ -171,7 +82,7 @@ class ActiveRosters(list):
         for roster in active_rosters:
             self.append(roster)
 
-    @property
+    @cached_property
     def consists_in_buy_menu_order(self):
         consists = []
         # first compose the buy menu order list
@@ -197,7 +108,7 @@ class ActiveRosters(list):
             )
         return consists
 
-    @property
+    @cached_property
     def restaurant_car_ids(self):
         result = []
         for roster in self:
@@ -213,7 +124,7 @@ class ActiveRosters(list):
             )
         return result
 
-    @property
+    @cached_property
     def haulage_bonus_engine_id_tree(self):
         # supports a BAD FEATURE easter egg, where some railcar speeds are increased when hauled by express engine, and can be used as fast MUs
         express_engine_ids = []
@@ -233,7 +144,7 @@ class ActiveRosters(list):
                         express_engine_ids.append(consist.id)
         return [(count, id) for count, id in enumerate(express_engine_ids)]
 
-    @property
+    @cached_property
     def cargo_sprinter_ids(self):
         # find cargo_sprinters
         # used to switch wagon company colours
@@ -250,7 +161,7 @@ class ActiveRosters(list):
             )
         return result
 
-    @property
+    @cached_property
     def pax_car_ids(self):
         # for pax cars with consist-specific liveries
         # will check for other neighbouring pax cars before showing brake car
@@ -274,7 +185,7 @@ class ActiveRosters(list):
             )
         return result
 
-    @property
+    @cached_property
     def livery_2_engine_ids(self):
         # for vehicles with consist-specific liveries
         # will switch vehicle to livery 2 for specific roles of lead engine
@@ -299,8 +210,126 @@ class ActiveRosters(list):
             )
         return result
 
+    def audit_picklability(self):
+        for roster in self:
+            roster.audit_picklability()
+
+
+# singleton, see get_active_rosters()
+active_rosters = None
+
+
+def get_active_rosters():
+    global active_rosters
+    if active_rosters is None:
+        active_rosters = ActiveRosters()
+        # one-time validation, it's slow, so not done every time the consists are accessed
+        active_rosters.audit_picklability()
+    return active_rosters
+
+
+def register_model():
+    # the railtype, roster, spritelayer cargo and vehicle modules are only needed to register the model, so they're imported here, not at module level
+    # that way loading a model snapshot doesn't pay for importing them
+    # this format of import is weird, but I don't want the imported modules directly in the iron horse namespace, I want to nest in spritelayer_cargos
+    from spritelayer_cargos import intermodal_containers
+
+    from spritelayer_cargos import automobiles
+
+    # import railtypes
+    from railtypes import metro
+    from railtypes import narrow_gauge
+    from railtypes import lgv
+    from railtypes import lgv_electrified
+
+    # import rosters
+    from rosters import pony
+
+    # import wagons
+    from vehicles import acid_tank_cars
+    from vehicles import aggregate_cars
+
+    # from vehicles import alignment_cars
+    from vehicles import automobile_cars
+    from vehicles import bolster_cars
+    from vehicles import box_cars
+    from vehicles import bulkhead_flat_cars
+    from vehicles import caboose_cars
+    from vehicles import goods_caboose_cars
+    from vehicles import carbon_black_hopper_cars
+    from vehicles import cement_silo_cars
+    from vehicles import chemical_covered_hopper_cars
+    from vehicles import coil_buggy_cars
+    from vehicles import coil_cars_covered
+    from vehicles import coil_cars_uncovered
+    from vehicles import covered_hopper_cars
+    from vehicles import cryo_tank_cars
+    from vehicles import curtain_side_box_cars
+    from vehicles import double_deck_automobile_cars
+    from vehicles import dry_powder_hopper_cars
+    from vehicles import dump_cars
+    from vehicles import dump_cars_high_side
+    from vehicles import edibles_tank_cars
+    from vehicles import express_cars
+    from vehicles import express_intermodal_cars
+    from vehicles import express_railcar_passenger_trailer_cars
+    from vehicles import farm_products_box_cars
+    from vehicles import farm_products_hopper_cars
+    from vehicles import flat_cars
+    from vehicles import goods_box_cars
+    from vehicles import hood_open_cars
+    from vehicles import hopper_cars
+    from vehicles import hst_mail_cars
+    from vehicles import hst_passenger_cars
+    from vehicles import ingot_cars
+    from vehicles import intermodal_cars
+    from vehicles import kaolin_hopper_cars
+    from vehicles import livestock_cars
+    from vehicles import log_cars
+    from vehicles import low_floor_automobile_cars
+    from vehicles import low_floor_intermodal_cars
+    from vehicles import mail_cars
+    from vehicles import merchandise_box_cars
+    from vehicles import merchandise_open_cars
+    from vehicles import mineral_covered_hopper_cars
+    from vehicles import mineral_hopper_cars
+    from vehicles import mgr_hopper_cars
+    from vehicles import open_cars
+    from vehicles import ore_dump_cars
+    from vehicles import ore_hopper_cars
+    from vehicles import passenger_cars
+    from vehicles import peat_cars
+    from vehicles import plate_cars
+    from vehicles import pressure_tank_cars
+    from vehicles import product_tank_cars
+    from vehicles import railbus_passenger_trailer_cars
+    from vehicles import railcar_passenger_trailer_cars
+    from vehicles import randomised_box_cars
+    from vehicles import randomised_bulk_cars
+    from vehicles import randomised_cold_metal_cars
+    from vehicles import randomised_dump_cars
+    from vehicles import randomised_flat_cars
+    from vehicles import randomised_hopper_cars
+    from vehicles import randomised_open_cars
+    from vehicles import randomised_piece_goods_cars
+    from vehicles import randomised_chemicals_tank_cars
+    from vehicles import reefer_cars
+    from vehicles import restaurant_cars
+    from vehicles import rock_hopper_cars
+    from vehicles import roller_roof_hopper_cars
+    from vehicles import scrap_metal_cars
+    from vehicles import silo_cars
+    from vehicles import skip_cars
+    from vehicles import slag_ladle_cars
+    from vehicles import sliding_roof_cars
+    from vehicles import sliding_wall_cars
+    from vehicles import suburban_passenger_cars
+    from vehicles import swing_roof_hopper_cars
+    from vehicles import tank_cars
+    from vehicles import tarpaulin_cars
+    from vehicles import torpedo_cars
+    from vehicles import vehicle_parts_box_cars
 
-def main():
     # railtypes - order is significant, as affects order in construction menu (order property not currently set)
     lgv.main(disabled=False)
     lgv_electrified.main(disabled=False)
@@ -400,3 +429,111 @@ def main():
     tarpaulin_cars.main()
     torpedo_cars.main()
     vehicle_parts_box_cars.main()
+
+    # all vehicles are registered, so derived vehicle properties can be computed once and cached
+    for roster in registered_rosters:
+        roster.freeze()
+
+
+def get_model_source_digest():
+    # the model is entirely defined by the python source, so any change to it invalidates the snapshot
+    # python version is included as pickles aren't guaranteed compatible across versions
+    # these reads aren't inputs for depfiles, or every render script would depend on all the source, the modules the model is built from are listed instead (see load_model_snapshot)
+    depfiles.ignore_reads()
+    hasher = hashlib.sha256(sys.version.encode())
+    for path in sorted(
+        glob.glob(os.path.join(currentdir, "src", "**", "*.py"), recursive=True)
+    ):
+        hasher.update(path.encode())
+        with open(path, "rb") as source_file:
+            hasher.update(source_file.read())
+    depfiles.record_reads()
+    return hasher.hexdigest()
+
+
+def load_model_snapshot(source_digest):
+    # returns True if the snapshot was loaded into the registries
+    if not os.path.exists(model_snapshot_path):
+        return False
+    with open(model_snapshot_path, "rb") as snapshot_file:
+        # digest is pickled first, so a stale snapshot can be rejected without loading the model
+        if pickle.load(snapshot_file) != source_digest:
+            return False
+        rosters, railtypes, spritelayer_cargos, numeric_ids, module_names = pickle.load(
+            snapshot_file
+        )
+    # the registries are imported by name in other modules, so fill them in place, don't replace them
+    registered_rosters.extend(rosters)
+    registered_railtypes.extend(railtypes)
+    registered_spritelayer_cargos.spritelayer_cargos = (
+        spritelayer_cargos.spritelayer_cargos
+    )
+    numeric_id_registry.owners = numeric_ids.owners
+    # frozen values aren't pickled with consists, so freeze again
+    for roster in registered_rosters:
+        roster.freeze()
+    # import the modules the model was registered from, they're not otherwise needed, but it's cheap, and makes them inputs in depfiles, same as registering the model
+    model_module_names.extend(module_names)
+    for module_name in model_module_names:
+        importlib.import_module(module_name)
+    return True
+
+
+def save_model_snapshot(source_digest):
+    # pickled together in one go, so objects shared between registries are still shared when loaded
+    model_snapshot_path_tmp = model_snapshot_path + "." + str(os.getpid()) + ".tmp"
+    with open(model_snapshot_path_tmp, "wb") as snapshot_file:
+        pickle.dump(source_digest, snapshot_file)
+        pickle.dump(
+            (
+                registered_rosters,
+                registered_railtypes,
+                registered_spritelayer_cargos,
+                numeric_id_registry,
+                model_module_names,
+            ),
+            snapshot_file,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    # other render scripts may be running in parallel (make -j), so write atomically
+    os.replace(model_snapshot_path_tmp, model_snapshot_path)
+
+
+def register_model_and_record_modules():
+    # modules already imported stay in the list, so re-registering in watch mode doesn't lose them
+    module_names_before = set(sys.modules.keys())
+    register_model()
+    new_module_names = set(sys.modules.keys()) - module_names_before
+    model_module_names[:] = sorted(set(model_module_names) | new_module_names)
+
+
+def reload_model(changed_module_names):
+    # for render_graphics --watch, re-registers the model in this process, re-importing the changed vehicle modules first
+    # the registries are imported by name in other modules, so empty them in place, don't replace them
+    global active_rosters
+    registered_rosters.clear()
+    registered_railtypes.clear()
+    registered_spritelayer_cargos.spritelayer_cargos = {}
+    numeric_id_registry.owners = {}
+    active_rosters = None
+    for module_name in changed_module_names:
+        if module_name in sys.modules:
+            importlib.reload(sys.modules[module_name])
+    register_model_and_record_modules()
+    # so the next make doesn't have to register the model again
+    save_model_snapshot(get_model_source_digest())
+
+
+def main():
+    # registering the model imports all the vehicle modules and builds every consist, and every render script needs it
+    # so the registered model is stored as a snapshot in generated/, and loaded instead when the source hasn't changed
+    global model_registered
+    if model_registered:
+        # already done in this process
+        return
+    model_registered = True
+    source_digest = get_model_source_digest()
+    if load_model_snapshot(source_digest):
+        return
+    register_model_and_record_modules()
+    save_model_snapshot(source_digest)
@@ -30,27 +30,53 @@ try:
     # truetype fonts may not be available in older versions of PIL / Pillow
     label_font = ImageFont.truetype(os.path.join("font", "slkscr.ttf"), 8)
 except:
-    # if truetype fonts are not available, 'None' will trigger fallback to PIL default bitmap font
-    label_font = None
+    # if truetype fonts are not available, fall back to the PIL default font
+    # load it once here, passing None would make every ImageDraw instance load it again
+    label_font = ImageFont.load_default()
 
 
 class ProcessingUnit(object):
     def __init__(self):
         pass
 
+    @property
+    def appended_height(self):
+        # height of any rows the unit adds to the spritesheet, used to preallocate the spritesheet layout
+        return 0
+
     def make_recolour_table(self, recolour_map):
-        table = []
-        for i in range(256):
-            if i in recolour_map.keys():
-                table.append(recolour_map[i])
-            else:
-                table.append(i)
-        return table
-
-    def selective_recolour(self, spritesheet, recolour_map):
+        return [recolour_map.get(i, i) for i in range(256)]
+
+    def selective_recolour(
+        self, spritesheet, recolour_map, target_box=None, whole_spritesheet=False
+    ):
+        # by default only the rows just appended are recoloured, so cost is proportional to the new pixels, not the whole sheet
+        # historically the recolour was applied to every filled row; to keep output identical, the narrower scope is only used
+        # when every colour in the earlier rows is left unchanged by the table, otherwise fall back to the whole filled sheet
         table = self.make_recolour_table(recolour_map)
-        result = spritesheet.sprites.point(table)
-        spritesheet.sprites.paste(result)
+        row_blocks = spritesheet.row_blocks
+        if target_box is not None:
+            spritesheet.recolour(target_box, table)
+            spritesheet.refresh_row_blocks(target_box[1], target_box[3])
+            return
+        if whole_spritesheet or row_blocks is None or len(row_blocks) == 0:
+            recolour_blocks = row_blocks
+        else:
+            recolour_blocks = row_blocks[-1:]
+            for row_block in row_blocks[:-1]:
+                if any(table[colour] != colour for colour in row_block[2]):
+                    recolour_blocks = row_blocks
+                    break
+        if not recolour_blocks:
+            top = 0
+        else:
+            top = recolour_blocks[0][0]
+            for row_block in recolour_blocks:
+                row_block[2] = set(table[colour] for colour in row_block[2])
+        # only the rows filled so far, the rest of a preallocated spritesheet is still blank
+        spritesheet.recolour(
+            (0, top, spritesheet.size[0], spritesheet.filled_height), table
+        )
         # doesn't need to return, the spritesheet object is already modified
 
 
@@ -66,14 +92,24 @@ class PassThrough(ProcessingUnit):
 
 
 class SimpleRecolour(ProcessingUnit):
-    """SimpleRecolour"""
+    """
+    SimpleRecolour
+    Recolours the rows just appended, unless a target box (left, upper, right, lower) or the whole spritesheet is requested.
+    """
 
-    def __init__(self, recolour_map):
+    def __init__(self, recolour_map, target_box=None, whole_spritesheet=False):
         self.recolour_map = recolour_map
+        self.target_box = target_box
+        self.whole_spritesheet = whole_spritesheet
         super().__init__()
 
     def render(self, spritesheet):
-        self.selective_recolour(spritesheet, self.recolour_map)
+        self.selective_recolour(
+            spritesheet,
+            self.recolour_map,
+            target_box=self.target_box,
+            whole_spritesheet=self.whole_spritesheet,
+        )
         return spritesheet
 
 
@@ -91,7 +127,8 @@ class SwapCompanyColours(ProcessingUnit):
         super().__init__()
 
     def render(self, spritesheet):
-        self.selective_recolour(spritesheet, self.recolour_map)
+        # company colours are swapped everywhere, not just in the latest rows
+        self.selective_recolour(spritesheet, self.recolour_map, whole_spritesheet=True)
         return spritesheet
 
 
@@ -113,25 +150,27 @@ class AppendToSpritesheet(ProcessingUnit):
             )
         super().__init__()
 
+    @property
+    def appended_height(self):
+        return self.crop_box[3] - self.crop_box[1]
+
     def render(self, spritesheet):
-        image_to_paste = self.spritesheet_to_paste.sprites.copy()
-        image_to_paste = image_to_paste.crop(
+        image_to_paste = self.spritesheet_to_paste.sprites.crop(
             (self.crop_box[0], self.crop_box[1], self.crop_box[2], self.crop_box[3])
         )
-        previous = spritesheet.sprites
-        width = previous.size[0]
-        height = previous.size[1] + image_to_paste.size[1]
-        temp = Image.new("P", (width, height), 255)
-        temp.putpalette(DOS_PALETTE)
-        temp.paste(previous, (0, 0, previous.size[0], previous.size[1]))
-        spritesheet.sprites = temp
-        box = (
-            0,
-            previous.size[1],
-            image_to_paste.size[0],
-            previous.size[1] + image_to_paste.size[1],
-        )
-        spritesheet.sprites.paste(image_to_paste, box)
+        top = spritesheet.filled_height
+        bottom = top + image_to_paste.size[1]
+        if bottom > spritesheet.size[1]:
+            # spritesheet wasn't preallocated, so grow it
+            spritesheet.crop_to_filled_height()
+            spritesheet.grow(bottom)
+        else:
+            # preallocated spritesheet, so write straight into the slot
+            # blank the full width of the slot first, other units may already have processed the whole canvas
+            spritesheet.fill((0, top, spritesheet.size[0], bottom), 255)
+        spritesheet.paste(image_to_paste, (0, top, image_to_paste.size[0], bottom))
+        spritesheet.filled_height = bottom
+        spritesheet.add_row_block(top, bottom)
         return spritesheet
 
 
@@ -146,20 +185,19 @@ class TransposeAsymmetricSprites(ProcessingUnit):
         self.row_map = row_map  # mapping of {row num to provide in col 1: row num to copy from in col 2}
 
     def render(self, spritesheet):
-        source = spritesheet.sprites.copy()
+        # rows are copied between blocks, so stop tracking them; any later recolour falls back to the whole sheet
+        spritesheet.row_blocks = None
+        # source (col 2) and dest (col 1) don't overlap, so rows can be copied directly without a snapshot of the sheet
         for dest_row, source_row in self.row_map.items():
             source_row_y_loc = 10 + ((source_row - 1) * self.spriterow_height)
-            content = source.copy().crop(
+            dest_row_y_loc = 10 + ((dest_row - 1) * self.spriterow_height)
+            spritesheet.copy_region(
                 (
                     self.bboxes[4][0],
                     source_row_y_loc,
                     self.bboxes[7][0] + self.bboxes[7][1],
                     source_row_y_loc + self.spriterow_height,
-                )
-            )
-            dest_row_y_loc = 10 + ((dest_row - 1) * self.spriterow_height)
-            spritesheet.sprites.paste(
-                content,
+                ),
                 (
                     self.bboxes[0][0],
                     dest_row_y_loc,
@@ -182,6 +220,8 @@ class AddBuyMenuSprite(ProcessingUnit):
         super().__init__()
 
     def render(self, spritesheet):
+        # the processing function can change pixels anywhere, so stop tracking row blocks
+        spritesheet.row_blocks = None
         return self.processing_function(spritesheet)
 
 
@@ -199,7 +239,8 @@ class AddCargoLabel(ProcessingUnit):
         super().__init__()
 
     def render(self, spritesheet):
-        position = (self.x_offset, spritesheet.sprites.size[1] + self.y_offset)
-        draw_cargo_labels = ImageDraw.Draw(spritesheet.sprites)
-        draw_cargo_labels.text(position, self.label, font=label_font)
+        position = (self.x_offset, spritesheet.filled_height + self.y_offset)
+        label_bbox = spritesheet.draw_text(position, self.label, font=label_font)
+        # the label colours are now in the rows, which matters for any later recolour
+        spritesheet.refresh_row_blocks(label_bbox[1], label_bbox[3])
         return spritesheet
@@ -6,17 +6,45 @@ Any changes made here are liable to be over-written.
 
 from PIL import Image, ImageDraw
 from copy import deepcopy
+import hashlib
+import numpy as np
 import os.path
 
 currentdir = os.curdir
 
 
+# measuring text is surprisingly slow, and the same few labels are drawn on many spritesheets, so memoise the size per process
+text_bboxes = {}
+
+
+def get_text_bbox(position, text, font):
+    if (text, font) not in text_bboxes:
+        draw = ImageDraw.Draw(Image.new("P", (1, 1)))
+        text_bboxes[(text, font)] = draw.textbbox((0, 0), text, font=font)
+    bbox = text_bboxes[(text, font)]
+    # positions are whole pixels, so the box just moves with the position
+    return (
+        bbox[0] + position[0],
+        bbox[1] + position[1],
+        bbox[2] + position[0],
+        bbox[3] + position[1],
+    )
+
+
 class Spritesheet:
     """
     Class holding the sprite sheet.
+    Graphics units work on the sheet via the methods here, so that the storage for the pixels can vary, see ArraySpritesheet.
 
     @ivar sprites: The sprite sheet.
     @type sprites: L{Image}
+
+    @ivar filled_height: Height of the rows written so far, may be less than the sheet height if the sheet was preallocated.
+    @type filled_height: C{int}
+
+    @ivar row_blocks: Blocks of filled rows as [top, bottom, colours], where colours is the exact set of palette indexes in the block.
+                      None if the sheet isn't tracking blocks, or a unit has changed pixels without updating them.
+    @type row_blocks: C{list} of C{list}, or C{None}
     """
 
     def __init__(self, width, height, palette):
@@ -34,14 +62,230 @@ class Spritesheet:
         """
         self.sprites = Image.new("P", (width, height), 255)
         self.sprites.putpalette(palette)
+        self.filled_height = height
+        self.row_blocks = None
+
+    @property
+    def size(self):
+        return self.sprites.size
+
+    def crop(self, box):
+        # returns a new PIL image, not a view
+        return self.sprites.crop(box)
+
+    def paste(self, image, box, mask=None):
+        self.sprites.paste(image, box, mask)
+
+    def fill(self, box, colour):
+        self.sprites.paste(colour, box)
+
+    def recolour(self, box, table):
+        self.sprites.paste(self.sprites.crop(box).point(table), box)
+
+    def copy_region(self, source_box, dest_box):
+        # only the source region is copied, not the whole sheet
+        self.sprites.paste(self.sprites.crop(source_box), dest_box)
+
+    def draw_text(self, position, text, font):
+        # returns the bounding box of the text, so callers know which rows changed
+        ImageDraw.Draw(self.sprites).text(position, text, font=font)
+        return get_text_bbox(position, text, font)
+
+    def grow(self, height):
+        # for sheets that weren't preallocated, new rows are blank
+        previous = self.sprites
+        self.sprites = Image.new("P", (previous.size[0], height), 255)
+        self.sprites.putpalette(previous.getpalette())
+        self.sprites.paste(previous, (0, 0, previous.size[0], previous.size[1]))
+
+    def get_colours_in_rows(self, top, bottom):
+        histogram = self.sprites.crop(
+            (0, top, self.sprites.size[0], bottom)
+        ).histogram()
+        return set(index for index, count in enumerate(histogram) if count > 0)
+
+    def track_row_blocks(self):
+        # start tracking from the rows filled so far, which are treated as a single block
+        self.row_blocks = []
+        self.add_row_block(0, self.filled_height)
+
+    def add_row_block(self, top, bottom):
+        if self.row_blocks is None:
+            return
+        self.row_blocks.append([top, bottom, self.get_colours_in_rows(top, bottom)])
+
+    def refresh_row_blocks(self, top, bottom):
+        # re-read colours for any blocks overlapping rows that were drawn on, cost is proportional to the blocks touched
+        if self.row_blocks is None:
+            return
+        for row_block in self.row_blocks:
+            if row_block[0] < bottom and row_block[1] > top:
+                row_block[2] = self.get_colours_in_rows(row_block[0], row_block[1])
+
+    def crop_to_filled_height(self):
+        # only needed if a preallocated sheet wasn't completely filled
+        if self.filled_height < self.sprites.size[1]:
+            self.sprites = self.sprites.crop(
+                (0, 0, self.sprites.size[0], self.filled_height)
+            )
+
+    def get_digest(self):
+        # digest of the raw pixels and palette, cheap compared to encoding a png, so it can be used to check if a sheet has changed
+        hasher = hashlib.sha256()
+        hasher.update(repr(self.sprites.size).encode())
+        hasher.update(bytes(self.sprites.getpalette()))
+        hasher.update(self.sprites.tobytes())
+        return hasher.hexdigest()
+
+    def save(self, output_path, png_options=None):
+        # png_options are passed to PIL, defaults to the smallest file
+        if png_options is None:
+            png_options = {"optimize": True}
+        self.sprites.save(output_path, **png_options)
+
+
+class ArraySpritesheet(Spritesheet):
+    """
+    Sprite sheet backed by a contiguous uint8 numpy array of palette indexes, instead of a PIL image.
+    Units work on views and slices of the array, so there are no full sheet copies; PIL is only used for text and at save.
+
+    @ivar pixels: Palette index for each pixel, indexed [y, x].
+    @type pixels: C{numpy.ndarray}
+
+    @ivar palette: Palette of the sprite sheet, applied at save.
+    @type palette: C{list} of (256*3) C{int}
+    """
+
+    def __init__(self, width, height, palette):
+        self.pixels = np.full((height, width), 255, dtype=np.uint8)
+        self.palette = palette
+        self.filled_height = height
+        self.row_blocks = None
+
+    @property
+    def size(self):
+        return (self.pixels.shape[1], self.pixels.shape[0])
+
+    def get_slices(self, box):
+        # PIL boxes are (left, upper, right, lower), clipped to the sheet as PIL would when pasting
+        left = max(box[0], 0)
+        upper = max(box[1], 0)
+        right = min(box[2], self.pixels.shape[1])
+        lower = min(box[3], self.pixels.shape[0])
+        return (slice(upper, lower), slice(left, right)), (
+            slice(upper - box[1], lower - box[1]),
+            slice(left - box[0], right - box[0]),
+        )
+
+    def crop(self, box):
+        return make_image_from_pixels(
+            self.pixels[box[1] : box[3], box[0] : box[2]], self.palette
+        )
+
+    def paste(self, image, box, mask=None):
+        # masks are treated as binary, which is all the pipelines use
+        dest, source = self.get_slices(box)
+        image_pixels = np.asarray(image)[source]
+        if mask is None:
+            self.pixels[dest] = image_pixels
+        else:
+            mask_pixels = np.asarray(mask)[source] != 0
+            self.pixels[dest][mask_pixels] = image_pixels[mask_pixels]
+
+    def fill(self, box, colour):
+        self.pixels[self.get_slices(box)[0]] = colour
+
+    def recolour(self, box, table):
+        region = self.pixels[self.get_slices(box)[0]]
+        region[...] = np.asarray(table, dtype=np.uint8)[region]
+
+    def copy_region(self, source_box, dest_box):
+        # numpy handles overlapping regions, so no intermediate copy is needed
+        source = self.pixels[
+            source_box[1] : source_box[3], source_box[0] : source_box[2]
+        ]
+        self.pixels[dest_box[1] : dest_box[3], dest_box[0] : dest_box[2]] = source
+
+    def draw_text(self, position, text, font):
+        # PIL draws the text, but only on the rows it covers, which are then written back
+        bbox = get_text_bbox(position, text, font)
+        top = max(bbox[1], 0)
+        bottom = min(bbox[3], self.pixels.shape[0])
+        if top >= bottom:
+            return bbox
+        rows_image = make_image_from_pixels(self.pixels[top:bottom], self.palette)
+        ImageDraw.Draw(rows_image).text(
+            (position[0], position[1] - top), text, font=font
+        )
+        self.pixels[top:bottom] = np.asarray(rows_image)
+        return bbox
 
-    def save(self, output_path):
-        self.sprites.save(output_path, optimize=True)
+    def grow(self, height):
+        previous = self.pixels
+        self.pixels = np.full((height, previous.shape[1]), 255, dtype=np.uint8)
+        self.pixels[: previous.shape[0]] = previous
+
+    def get_colours_in_rows(self, top, bottom):
+        histogram = np.bincount(self.pixels[top:bottom].ravel(), minlength=256)
+        return set(np.flatnonzero(histogram).tolist())
+
+    def crop_to_filled_height(self):
+        self.pixels = self.pixels[: self.filled_height]
+
+    def get_digest(self):
+        # as Spritesheet.get_digest(), and matches it for the same pixels and palette
+        hasher = hashlib.sha256()
+        hasher.update(repr(self.size).encode())
+        hasher.update(bytes(self.palette))
+        hasher.update(np.ascontiguousarray(self.pixels).tobytes())
+        return hasher.hexdigest()
+
+    def save(self, output_path, png_options=None):
+        # as Spritesheet.save()
+        if png_options is None:
+            png_options = {"optimize": True}
+        make_image_from_pixels(self.pixels, self.palette).save(
+            output_path, **png_options
+        )
+
+
+class SpritesheetLayout:
+    """
+    Builds the layout of a spritesheet before any pixels are processed, so the sheet can be allocated once at its final size.
+    Rows are then appended straight into their slots, instead of re-allocating and copying the whole sheet for every append.
+    """
+
+    def __init__(self, width, initial_height):
+        """
+        @param width: Width of the sprite sheet.
+        @type  width: C{int}
+
+        @param initial_height: Height of the initial image, rows are appended below this.
+        @type  initial_height: C{int}
+        """
+        self.width = width
+        self.height = initial_height
+
+    def add_rows(self, height):
+        # returns the y position of the slot for the rows
+        y_offset = self.height
+        self.height = self.height + height
+        return y_offset
+
+    def make_spritesheet(self, input_image, palette):
+        spritesheet = ArraySpritesheet(
+            width=self.width, height=self.height, palette=palette
+        )
+        spritesheet.paste(input_image, (0, 0) + input_image.size)
+        spritesheet.filled_height = input_image.size[1]
+        spritesheet.track_row_blocks()
+        return spritesheet
 
 
 class PieceCargoSprites:
     """
     Convenience class to hold sprites for piece cargos, sliced up by angle
+    Use get_piece_cargo_sprites() rather than constructing directly, so the pngs are loaded and sliced once per process (and again if they change), not once per consist
     """
 
     def __init__(self, polar_fox_constants, polar_fox_graphics_path):
@@ -50,33 +294,39 @@ class PieceCargoSprites:
         # similarly the path to polar fox graphics must be set explicitly as it varies by scope
         self.polar_fox_constants = polar_fox_constants
         self.sprites_by_filename = {}
-        # it may be undesirable for performance reasons to slice all the sprites on init, but I think we can chance it eh?
-        for (
-            cargo_filename
-        ) in self.polar_fox_constants.piece_sprites_to_cargo_labels_maps.keys():
-            cargo_sprites_input_path = os.path.join(
-                currentdir,
-                polar_fox_graphics_path,
-                "piece_cargos",
-                cargo_filename + ".png",
-            )
+        # sliced (sprite, mask) tuples, built on first request for each (cargo_filename, length)
+        self.sprites_by_filename_and_length = {}
+        for cargo_filename, cargo_sprites_input_path in get_piece_cargo_input_paths(
+            polar_fox_constants, polar_fox_graphics_path
+        ):
             cargo_sprites_input_image = Image.open(cargo_sprites_input_path)
             self.sprites_by_filename[cargo_filename] = cargo_sprites_input_image.copy()
             # don't leave open files around, it can hit open file limits on macOs, maybe elsewhere; we've copied the Image object above to avoid needing the file handle
             cargo_sprites_input_image.close()
+        self._cargo_spritesheet_bounding_boxes = (
+            self.get_cargo_spritesheet_bounding_boxes()
+        )
 
     def get_cargo_sprites_all_angles_for_length(self, cargo_filename, length):
-        # provide a list, with a two-tuple (cargo_sprite, mask) for each of 4 angles
+        # provide a tuple, with a two-tuple (cargo_sprite, mask) for each of 4 angles
         # cargo sprites are assumed to be symmetrical, only 4 angles are needed
         # cargos with 8 angles (e.g. bulldozers) aren't supported, use a different gestalt & template for those (dedicated or custom)
         # loading states are first 4 sprites, loaded are second 4, all in one list, just pick them out as needed
-        return get_arbitrary_angles(
-            self.sprites_by_filename[cargo_filename],
-            self.cargo_spritesheet_bounding_boxes[length],
-        )
+        # the sprites and masks are shared by every caller, so treat them as read-only
+        if (cargo_filename, length) not in self.sprites_by_filename_and_length:
+            self.sprites_by_filename_and_length[(cargo_filename, length)] = tuple(
+                get_arbitrary_angles(
+                    self.sprites_by_filename[cargo_filename],
+                    self.cargo_spritesheet_bounding_boxes[length],
+                )
+            )
+        return self.sprites_by_filename_and_length[(cargo_filename, length)]
 
     @property
     def cargo_spritesheet_bounding_boxes(self):
+        return self._cargo_spritesheet_bounding_boxes
+
+    def get_cargo_spritesheet_bounding_boxes(self):
         # Cargo spritesheets provide multiple lengths, using a specific format of rows
         # given a base set, find the bounding boxes for the rows per length
         cargo_spritesheet_bounding_boxes = {}
@@ -96,6 +346,50 @@ class PieceCargoSprites:
         return cargo_spritesheet_bounding_boxes
 
 
+def get_piece_cargo_input_paths(polar_fox_constants, polar_fox_graphics_path):
+    # (cargo_filename, path) for each of the piece cargo pngs
+    return [
+        (
+            cargo_filename,
+            os.path.join(
+                currentdir,
+                polar_fox_graphics_path,
+                "piece_cargos",
+                cargo_filename + ".png",
+            ),
+        )
+        for cargo_filename in polar_fox_constants.piece_sprites_to_cargo_labels_maps.keys()
+    ]
+
+
+# one PieceCargoSprites per graphics path, per process, as graphics path: (stats of the pngs when loaded, PieceCargoSprites)
+piece_cargo_sprites_registry = {}
+
+
+def get_piece_cargo_sprites(polar_fox_constants, polar_fox_graphics_path):
+    # the pngs are checked for changes on every call, as long-lived processes (e.g. render_graphics --watch pool workers) must not keep serving stale sprites
+    input_stats = []
+    for cargo_filename, path in get_piece_cargo_input_paths(
+        polar_fox_constants, polar_fox_graphics_path
+    ):
+        stat = os.stat(path)
+        input_stats.append((path, stat.st_mtime_ns, stat.st_size))
+    registry_entry = piece_cargo_sprites_registry.get(polar_fox_graphics_path, None)
+    if registry_entry is None or registry_entry[0] != input_stats:
+        piece_cargo_sprites_registry[polar_fox_graphics_path] = (
+            input_stats,
+            PieceCargoSprites(
+                polar_fox_constants=polar_fox_constants,
+                polar_fox_graphics_path=polar_fox_graphics_path,
+            ),
+        )
+    return piece_cargo_sprites_registry[polar_fox_graphics_path][1]
+
+
+# blue (index 0) is transparent, everything else is opaque
+mask_table = [0] + [255] * 255
+
+
 def get_arbitrary_angles(input_image, bounding_boxes):
     # given an image and a list of arbitrary bounding boxes...
     # ...return a list of two tuples with sprite and mask
@@ -103,15 +397,10 @@ def get_arbitrary_angles(input_image, bounding_boxes):
     # note the arbitrary order of sprites which makes this very flexible
     result = []
     for bounding_box in bounding_boxes:
-        sprite = input_image.copy()
-        sprite = sprite.crop(bounding_box)
-        mask = sprite.copy()
-        # !! .point is noticeably slow although not signifcantly so with only 3 cargo types
-        # !! check this again if optimisation is a concern - can cargos be processed once and passed to the pipeline?
-        # !! as of Oct 2018, I tested commenting out *all* piece cargo processing, including calls to this method
-        # !! that cut only 1s from an 11s graphics processing run on single CPU
-        # !! so optimising this is TMWFTLB currently; instead simply using multiprocessing cuts graphics run to 2s
-        mask = mask.point(lambda i: 0 if i == 0 else 255).convert("1")
+        # crop returns a new image, so there's no need to copy the whole input image first
+        sprite = input_image.crop(bounding_box)
+        # a plain lookup table is much faster for .point than a lambda, which PIL calls (and rounds) for every index
+        mask = sprite.point(mask_table).convert("1")
         result.append((sprite, mask))
     return result
 
@@ -159,6 +448,17 @@ def make_cheatsheet(image, output_path, origin=None):
     result.save(output_path, optimize=True)
 
 
+def make_image_from_pixels(pixels, palette):
+    # copies the pixels, so the image doesn't share memory with the array
+    image = Image.frombytes(
+        "P",
+        (pixels.shape[1], pixels.shape[0]),
+        np.ascontiguousarray(pixels).tobytes(),
+    )
+    image.putpalette(palette)
+    return image
+
+
 def make_spritesheet_from_image(input_image, palette):
     # convenience method to get a spritesheet from a passed PIL image
     spritesheet = Spritesheet(
@@ -187,3 +487,87 @@ def pixascan(image):
             if colour not in (0, 255):  # don't store white, blue; assumes DOS palette
                 significant_pixels.append((x, y, colour))
     return significant_pixels
+
+
+class LocPointIndex:
+    """
+    Finds loc points (pixels of specific colours) in an image in one vectorised pass, and indexes them by angle.
+    Replaces pixascan for loc points, which walked every pixel of the image in python.
+    """
+
+    def __init__(self, image, colours, angle_x_starts, x_offset=0, y_offset=0):
+        """
+        @param image: Source image.
+        @type  image: L{PIL.Image}
+
+        @param colours: Palette indexes of the loc points to find.
+        @type  colours: C{list} of C{int}
+
+        @param angle_x_starts: x position of the start of the bounding box for each angle, in ascending order.
+        @type  angle_x_starts: C{list} of C{int}
+
+        @param x_offset: Offset added to x of each loc point, e.g. if the image was cropped from a larger spritesheet.
+        @type  x_offset: C{int}
+
+        @param y_offset: Offset added to y of each loc point.
+        @type  y_offset: C{int}
+        """
+        pixels = np.asarray(image)
+        # transpose so that points are found in the same order pixascan used (columns first, top to bottom)
+        xs, ys = np.nonzero(np.isin(pixels.T, colours))
+        self.colours = pixels[ys, xs]
+        self.xs = xs + x_offset
+        self.ys = ys + y_offset
+        # x positions left of the first angle are treated as angle 0, consistent with the previous loops over bounding boxes
+        self.angle_indexes = np.maximum(
+            np.searchsorted(angle_x_starts, self.xs, side="right") - 1, 0
+        )
+
+    def get_loc_points(self, indexes):
+        # plain ints, not numpy types, so they can be used directly in PIL boxes
+        return list(
+            zip(
+                self.xs[indexes].tolist(),
+                self.ys[indexes].tolist(),
+                self.colours[indexes].tolist(),
+                self.angle_indexes[indexes].tolist(),
+            )
+        )
+
+    def get_loc_points_sorted_by_y(self):
+        """
+        Sorting in y order causes sprites to overlap correctly when there are multiple loc points for an angle.
+
+        @return: Loc points sorted by y, ties in scan order.
+        @rtype:  A C{list} of C{tuple} (x, y, colour, angle_index)
+        """
+        return self.get_loc_points(np.argsort(self.ys, kind="stable"))
+
+    def get_loc_points_grouped_by_angle(self, angle_bounding_boxes, colour_order):
+        """
+        Loc points in each angle's bounding box, sorted by the position of their colour in colour_order, ties in scan order.
+        Loc points outside all of the bounding boxes are dropped.
+
+        @param angle_bounding_boxes: (x, width, height) for each angle, not overlapping, as per global constants.
+        @type  angle_bounding_boxes: C{list} of C{tuple}
+
+        @param colour_order: Palette indexes in the order loc points should be sorted.
+        @type  colour_order: C{list} of C{int}
+
+        @return: Loc points for each angle.
+        @rtype:  A C{dict} of angle_index: C{list} of C{tuple} (x, y, colour, angle_index)
+        """
+        colour_rank_lookup = np.zeros(256, dtype=np.intp)
+        colour_rank_lookup[colour_order] = np.arange(len(colour_order))
+        colour_ranks = colour_rank_lookup[self.colours]
+        result = {}
+        for angle_index, bbox in enumerate(angle_bounding_boxes):
+            in_bbox = np.nonzero(
+                (self.angle_indexes == angle_index)
+                & (self.xs >= bbox[0])
+                & (self.xs <= bbox[0] + bbox[1])
+            )[0]
+            result[angle_index] = self.get_loc_points(
+                in_bbox[np.argsort(colour_ranks[in_bbox], kind="stable")]
+            )
+        return result
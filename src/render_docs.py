@@ -5,25 +5,28 @@ import sys
 import os
 
 currentdir = os.curdir
-import multiprocessing
 from time import time
 from PIL import Image
 import markdown
 import json
 from collections import defaultdict
 
+import depfiles
 import iron_horse
 import utils
 import global_constants
 from polar_fox import git_info
+from worker_pool import WorkerPool
 
-# get the strings from base lang file so they can be used in docs
-base_lang_strings = utils.parse_base_lang()
+# strings from the base lang file so they can be used in docs
+# populated by main(), not on import, as the lang file may not be generated yet when build.py imports this
+base_lang_strings = {}
 metadata = {}
 metadata.update(global_constants.metadata)
 
 # get args passed by makefile
 makefile_args = utils.get_makefile_args(sys)
+build_profile = utils.get_build_profile(makefile_args)
 
 docs_src = os.path.join(currentdir, "src", "docs_templates")
 
@@ -802,26 +805,42 @@ def render_docs_images(consist):
                 "img",
                 consist.id + "_" + colour_name + ".png",
             )
-            processed_vehicle_image.save(output_path, optimize=True, transparency=0)
+            processed_vehicle_image.save(
+                output_path, transparency=0, **build_profile["png_options"]
+            )
     source_vehicle_image.close()
 
 
-def main():
+# consists for docs image tasks, looked up by id in the worker
+# populated by main() before the worker pool is created, so pool workers inherit them and nothing needs pickling
+consists_by_id = {}
+
+
+def render_docs_images_task(consist_id):
+    if consist_id not in consists_by_id:
+        # a pool shared across build stages is forked before main() runs, but the model is already registered, so just look it up here
+        for consist in iron_horse.get_active_rosters().consists_in_buy_menu_order:
+            consists_by_id[consist.id] = consist
+    render_docs_images(consists_by_id[consist_id])
+
+
+# a worker_pool can be passed in when this is run as a stage of build.py, otherwise the stage creates its own
+def main(worker_pool=None):
     if makefile_args.get("suppress_docs", False):
         print("[SKIPPING DOCS] render_docs.py (suppress_docs makefile flag set)")
         return
     print("[RENDER DOCS] render_docs.py")
     start = time()
+    depfiles.start_recording()
     iron_horse.main()
+    base_lang_strings.update(utils.parse_base_lang())
 
     # default to no mp, makes debugging easier (mp fails to pickle errors correctly)
     num_pool_workers = makefile_args.get("num_pool_workers", 0)
     if num_pool_workers == 0:
-        use_multiprocessing = False
         # just print, no need for a coloured echo_message
         print("Multiprocessing disabled: (PW=0)")
     else:
-        use_multiprocessing = True
         # logger = multiprocessing.log_to_stderr()
         # logger.setLevel(25)
         # just print, no need for a coloured echo_message
@@ -834,6 +853,13 @@ def main():
     if not os.path.exists(chameleon_cache_path):
         os.mkdir(chameleon_cache_path)
     os.environ["CHAMELEON_CACHE"] = chameleon_cache_path
+    # that's too late if chameleon was already imported, e.g. by render_lang in the same process, and docs is ~100x slower with no cache
+    import chameleon.config
+
+    if chameleon.config.CACHE_DIRECTORY != os.path.abspath(chameleon_cache_path):
+        raise BaseException(
+            "chameleon was imported before CHAMELEON_CACHE was set, set it before importing other render scripts (see build.py)"
+        )
 
     docs_output_path = os.path.join(currentdir, "docs")
     if os.path.exists(docs_output_path):
@@ -847,7 +873,7 @@ def main():
     shutil.copytree(static_dir_src, static_dir_dst)
 
     # import iron_horse inside main() as it's so slow to import, and should only be imported explicitly
-    consists = iron_horse.ActiveRosters().consists_in_buy_menu_order
+    consists = iron_horse.get_active_rosters().consists_in_buy_menu_order
     # default sort for docs is by intro date
     consists = sorted(consists, key=lambda consist: consist.intro_date)
     dates = sorted([i.intro_date for i in consists])
@@ -900,19 +926,29 @@ def main():
 
     # process images for use in docs
     # yes, I really did bother using a pool to save at best a couple of seconds, because FML :)
+    if not build_profile["docs_images"]:
+        # just print, no need for a coloured echo_message
+        print("Skipping docs images (build profile)")
+        depfiles.write_depfile("docs", "docs")
+        print(format((time() - start), ".2f") + "s")
+        return
     slow_start = time()
-    if use_multiprocessing == False:
-        for consist in consists:
-            render_docs_images(consist)
-    else:
-        # Would this go faster if the pipelines from each consist were placed in MP pool, not just the consist?
-        # probably potato / potato tbh
-        pool = multiprocessing.Pool(processes=num_pool_workers)
-        pool.map(render_docs_images, consists)
-        pool.close()
-        pool.join()
+    tasks = {}
+    for consist in consists:
+        consists_by_id[consist.id] = consist
+        tasks[("docs_images", consist.id)] = (render_docs_images_task, consist.id)
+    # the pool is created once everything the tasks need is in place, workers are forked so they inherit it
+    owns_worker_pool = worker_pool is None
+    if owns_worker_pool:
+        worker_pool = WorkerPool(num_pool_workers)
+    worker_pool.run_tasks(tasks, {})
+    if owns_worker_pool:
+        worker_pool.close()
     print("render_docs_images", time() - slow_start)
 
+    # the images are processed in pool workers, which the depfile doesn't see, they read the generated graphics (already a prerequisite) and the palette
+    depfiles.write_depfile("docs", "docs", ["palette_key.png"])
+
     print(format((time() - start), ".2f") + "s")
 
 
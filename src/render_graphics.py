@@ -5,32 +5,149 @@ import sys
 import os
 
 currentdir = os.curdir
-from multiprocessing import Pool
 import multiprocessing
 
 logger = multiprocessing.log_to_stderr()
 logger.setLevel(25)
-from time import time
+import traceback
+from time import sleep, time
 
+import depfiles
 import iron_horse
 import utils
 import global_constants
+from gestalt_graphics import asset_cache
+from gestalt_graphics.output_manifest import output_manifest
+from gestalt_graphics.dependency_manifest import dependency_manifest
+from gestalt_graphics.render_cache import get_pipeline_code_version
+from gestalt_graphics import render_plan
+from worker_pool import WorkerPool
 
 
-def run_consist_pipelines(consist):
-    if len(consist.gestalt_graphics.pipelines) == 0:
-        raise Exception("no pipelines")
-    else:
-        # run pipelines, obvs
-        for pipeline in consist.gestalt_graphics.pipelines:
-            pipeline.render(consist, global_constants)
+graphics_input_path = os.path.join(currentdir, "src", "graphics")
+graphics_output_path = os.path.join(iron_horse.generated_files_path, "graphics")
+# graphics that are used as-is, so they're just copied
+unprocessed_graphics_dir_names = ["railtypes", "signals", "tail_lights"]
+
+# dirs polled for changes in --watch mode, and seconds between polls
+watch_paths = [
+    graphics_input_path,
+    # piece cargo sprites are here
+    os.path.join(currentdir, "src", "polar_fox", "graphics"),
+    os.path.join(currentdir, "src", "vehicles"),
+    os.path.join(currentdir, "src", "templates"),
+]
+watch_poll_interval = 0.5
+
+
+def get_vehicle_spritesheet_task_ids(consist_render_plans):
+    # the tasks for pipelines that write the generated vehicle spritesheet for a consist
+    return [
+        ("pipeline", consist_render_plan.id, consist_render_plan.pipeline_index)
+        for consist_render_plan in consist_render_plans
+        if consist_render_plan.pipeline.writes_vehicle_spritesheet
+    ]
+
+
+def get_render_tasks(consists, spritelayer_cargo_set_pairs, build_profile):
+    # compiles a render plan for each pipeline, plans hold no consists or rosters so they can be passed to pool workers as the task key
+    # returns a dict of task_id: (function, render_plan), and a dict of task_id: [task_ids it depends on], as used by WorkerPool
+    # task ids are just tuples, unique per task
+    tasks = {}
+    dependencies = {}
+    for spritelayer_cargo, cargo_set in spritelayer_cargo_set_pairs:
+        for pipeline_index in range(
+            len(spritelayer_cargo.gestalt_graphics.spritelayer_cargo_pipelines)
+        ):
+            cargo_set_render_plan = render_plan.CargoSetRenderPlan(
+                spritelayer_cargo, cargo_set, pipeline_index, build_profile
+            )
+            # keyed on the id, not position, as cargo sets aren't in a stable order between runs, and task ids are kept in the dependency manifest
+            task_id = ("spritelayer_cargo_set", cargo_set_render_plan.id, pipeline_index)
+            tasks[task_id] = (render_plan.run_render_plan, cargo_set_render_plan)
+    render_plans_by_consist_id = {}
+    for consist in consists:
+        if len(consist.gestalt_graphics.pipelines) == 0:
+            raise BaseException("no pipelines for " + consist.id)
+        render_plans_by_consist_id[consist.id] = [
+            render_plan.ConsistRenderPlan(consist, pipeline_index, build_profile)
+            for pipeline_index in range(len(consist.gestalt_graphics.pipelines))
+        ]
+    for consist_id, consist_render_plans in render_plans_by_consist_id.items():
+        for consist_render_plan in consist_render_plans:
+            pipeline = consist_render_plan.pipeline
+            task_id = ("pipeline", consist_id, consist_render_plan.pipeline_index)
+            tasks[task_id] = (render_plan.run_render_plan, consist_render_plan)
+            dependencies[task_id] = []
+            # e.g. pantograph spritesheets use the generated vehicle spritesheet for debug rows
+            if pipeline.reads_vehicle_spritesheet:
+                dependencies[task_id].extend(
+                    get_vehicle_spritesheet_task_ids(consist_render_plans)
+                )
+            # some pipelines depend on generated spritesheets from other consists, e.g. randomised wagons need the candidate wagons
+            for dependency_consist_id in set(
+                pipeline.get_dependency_consist_ids(consist_render_plan)
+            ):
+                if dependency_consist_id in render_plans_by_consist_id:
+                    dependencies[task_id].extend(
+                        get_vehicle_spritesheet_task_ids(
+                            render_plans_by_consist_id[dependency_consist_id]
+                        )
+                    )
+    return tasks, dependencies
+
+
+def get_stale_task_ids(tasks, dependencies, pipeline_version):
+    # tasks are stale if anything they read last time has changed, or they haven't been run before
+    # tasks depending on a stale task are stale too, as the generated spritesheets they read are about to change
+    stale_task_ids = set(
+        task_id
+        for task_id, (function, task_render_plan) in tasks.items()
+        if not dependency_manifest.is_up_to_date(
+            task_id, render_plan.get_digest(task_render_plan), pipeline_version
+        )
+    )
+    found_stale = True
+    while found_stale:
+        found_stale = False
+        for task_id in tasks:
+            if task_id in stale_task_ids:
+                continue
+            if any(
+                dependency in stale_task_ids
+                for dependency in dependencies.get(task_id, [])
+            ):
+                stale_task_ids.add(task_id)
+                found_stale = True
+    return stale_task_ids
 
 
-def run_spritelayer_cargo_set_pipelines(spritelayer_cargo_set_pair):
-    for pipeline in spritelayer_cargo_set_pair[
-        0
-    ].gestalt_graphics.spritelayer_cargo_pipelines:
-        pipeline.render(spritelayer_cargo_set_pair, global_constants)
+def report_skipped_tasks(tasks, stale_task_ids):
+    # consists and spritelayer cargo sets are only skipped if all their pipelines are
+    ids_by_type = {}
+    stale_ids_by_type = {}
+    for task_id in tasks:
+        ids_by_type.setdefault(task_id[0], set()).add(task_id[1])
+        if task_id in stale_task_ids:
+            stale_ids_by_type.setdefault(task_id[0], set()).add(task_id[1])
+    task_type_names = {
+        "pipeline": "consists",
+        "spritelayer_cargo_set": "spritelayer cargo sets",
+    }
+    for task_type, ids in sorted(ids_by_type.items()):
+        stale_ids = stale_ids_by_type.get(task_type, set())
+        print(
+            "Skipped",
+            len(ids) - len(stale_ids),
+            "of",
+            len(ids),
+            task_type_names[task_type] + ",",
+            "inputs unchanged since last run",
+        )
+    # listing them is useful when iterating on a few vehicles, but not when everything is rendered
+    stale_consist_ids = stale_ids_by_type.get("pipeline", set())
+    if 0 < len(stale_consist_ids) <= 20:
+        print("Rendering", ", ".join(sorted(stale_consist_ids)))
 
 
 def report_sprites_complete(consists):
@@ -56,26 +173,85 @@ def report_sprites_complete(consists):
         print("  *", track_type, len(incomplete_consists))
 
 
+def copy_unprocessed_graphics_dir(dir_name):
+    target_path = os.path.join(graphics_input_path, dir_name)
+    dest_path = os.path.join(graphics_output_path, dir_name)
+    if os.path.exists(dest_path):
+        shutil.rmtree(dest_path)
+    shutil.copytree(target_path, dest_path)
+
+
+def render_stale_tasks(worker_pool, makefile_args):
+    # renders the spritesheets for tasks whose inputs have changed since they last ran, returns all the tasks, stale or not
+    consists = iron_horse.get_active_rosters().consists_in_buy_menu_order
+
+    # get a list of 2-tuple pairs for spritelayer cargos + cargo sets
+    # a list format is wanted for convenience with graphics multiprocessing pool
+    # the parent spritelayer_cargo object must be passed with the cargo set as cargo sets have render-time properties which change according to context
+    # but cargo_sets are global and reused across spritelayer_cargos, so they can't just store a single reference to their spritelayer_cargo parent
+    spritelayer_cargo_set_pairs = []
+    for spritelayer_cargo in iron_horse.registered_spritelayer_cargos:
+        for cargo_set in spritelayer_cargo.cargo_sets:
+            spritelayer_cargo_set_pairs.append((spritelayer_cargo, cargo_set))
+
+    # pipelines are run from render plans, compiled here from the roster model, so workers never need rosters or consists
+    tasks, dependencies = get_render_tasks(
+        consists,
+        spritelayer_cargo_set_pairs,
+        utils.get_build_profile(makefile_args),
+    )
+    # the pipeline code and build profile apply to every task
+    pipeline_version = [
+        get_pipeline_code_version(),
+        makefile_args.get("build_profile", "release"),
+    ]
+    dependency_manifest.load()
+    stale_task_ids = get_stale_task_ids(tasks, dependencies, pipeline_version)
+    report_skipped_tasks(tasks, stale_task_ids)
+    stale_tasks = dict(
+        (task_id, task) for task_id, task in tasks.items() if task_id in stale_task_ids
+    )
+    # each task returns its asset cache stats, output manifest updates, and the files it read and wrote
+    task_results = worker_pool.run_tasks(stale_tasks, dependencies)
+
+    report_sprites_complete(consists)
+
+    total_asset_cache_stats = {}
+    output_manifest_updates = {}
+    for task_id, (stats, updates, records) in task_results.items():
+        asset_cache.add_stats(total_asset_cache_stats, stats)
+        output_manifest_updates.update(updates)
+        if len(records) > 0:
+            dependency_manifest.update(
+                task_id,
+                render_plan.get_digest(stale_tasks[task_id][1]),
+                pipeline_version,
+                records,
+            )
+    asset_cache.report_stats(total_asset_cache_stats)
+    output_manifest.save(output_manifest_updates)
+    dependency_manifest.save()
+    return tasks
+
+
 # wrapped in a main() function so this can be called explicitly, because unexpected multiprocessing fork bombs are bad
-def main():
+# a worker_pool can be passed in when this is run as a stage of build.py, otherwise the stage creates its own
+def main(worker_pool=None):
     print("[RENDER GRAPHICS] render_graphics.py")
     start = time()
+    depfiles.start_recording()
     iron_horse.main()
     # get args passed by makefile
     makefile_args = utils.get_makefile_args(sys)
     # default to no mp, makes debugging easier (mp fails to pickle errors correctly)
     num_pool_workers = makefile_args.get("num_pool_workers", 0)
     if num_pool_workers == 0:
-        use_multiprocessing = False
         # just print, no need for a coloured echo_message
         print("Multiprocessing disabled: (PW=0)")
     else:
-        use_multiprocessing = True
         # just print, no need for a coloured echo_message
         print("Multiprocessing enabled: (PW=" + str(num_pool_workers) + ")")
 
-    graphics_input_path = os.path.join(currentdir, "src", "graphics")
-    graphics_output_path = os.path.join(iron_horse.generated_files_path, "graphics")
     if not os.path.exists(graphics_output_path):
         os.mkdir(graphics_output_path)
 
@@ -89,60 +265,116 @@ def main():
     )
     hint_file.close()
 
-    consists = iron_horse.ActiveRosters().consists_in_buy_menu_order
+    owns_worker_pool = worker_pool is None
+    if owns_worker_pool:
+        worker_pool = WorkerPool(num_pool_workers)
+    tasks = render_stale_tasks(worker_pool, makefile_args)
+    if owns_worker_pool:
+        worker_pool.close()
 
-    for consist in consists:
-        # rosters won't pickle reliably, and blow up multiprocessing, never figured out why
-        # work around that by freezing anything for graphics processing that depends on roster lookups
-        consist.freeze_cross_roster_lookups()
+    for dir_name in unprocessed_graphics_dir_names:
+        copy_unprocessed_graphics_dir(dir_name)
 
-    # get a list of 2-tuple pairs for spritelayer cargos + cargo sets
-    # a list format is wanted for convenience with graphics multiprocessing pool
-    # the parent spritelayer_cargo object must be passed with the cargo set as cargo sets have render-time properties which change according to context
-    # but cargo_sets are global and reused across spritelayer_cargos, so they can't just store a single reference to their spritelayer_cargo parent
-    spritelayer_cargo_set_pairs = []
-    for spritelayer_cargo in iron_horse.registered_spritelayer_cargos:
-        for cargo_set in spritelayer_cargo.cargo_sets:
-            spritelayer_cargo_set_pairs.append((spritelayer_cargo, cargo_set))
+    # the pipelines run in pool workers, so the files they read are taken from the dependency manifest
+    depfiles.write_depfile(
+        os.path.join(global_constants.generated_files_dir, "graphics", "make_target"),
+        "graphics",
+        dependency_manifest.get_input_paths(tasks.keys()),
+    )
 
-    # sort the consists in priority processing order, priority 1 is first
-    # this enables some consists to depend on generated sprites from other consists
-    consists_in_priority_groups = {1:[], 2:[]}
-    for consist in consists:
-        consists_in_priority_groups[consist.gestalt_graphics.processing_priority].append(consist)
-
-    if use_multiprocessing == False:
-        for spritelayer_cargo_set_pair in spritelayer_cargo_set_pairs:
-            run_spritelayer_cargo_set_pipelines(spritelayer_cargo_set_pair)
-        for processing_priority in [1, 2]:
-            for consist in consists_in_priority_groups[processing_priority]:
-                run_consist_pipelines(consist)
-    else:
-        # Would this go faster if the pipelines from each consist were placed in MP pool, not just the consist?
-        # probably potato / potato tbh
-        pool = Pool(processes=num_pool_workers)
-        pool.map(run_spritelayer_cargo_set_pipelines, spritelayer_cargo_set_pairs)
-        pool.close()
-        pool.join()
-        # wait for first pool job to finish before starting further pool jobs
-        # vehicle pool jobs are repeated so that some vehicles can depend on generated sprites from others
-        for processing_priority in [1, 2]:
-            pool = Pool(processes=num_pool_workers)
-            pool.map(run_consist_pipelines, consists_in_priority_groups[processing_priority])
-            pool.close()
-            pool.join()
+    print(format((time() - start), ".2f") + "s")
 
-    report_sprites_complete(consists)
 
-    for dir_name in ["railtypes", "signals", "tail_lights"]:
-        target_path = os.path.join(graphics_input_path, dir_name)
-        dest_path = os.path.join(graphics_output_path, dir_name)
-        if os.path.exists(dest_path):
-            shutil.rmtree(dest_path)
-        shutil.copytree(target_path, dest_path)
+def get_watched_file_stats():
+    # size and mtime of every file in the watched dirs, polling is crude, but it's portable and fast enough for a few thousand files
+    result = {}
+    for watch_path in watch_paths:
+        for dir_path, dir_names, file_names in os.walk(watch_path):
+            dir_names[:] = [
+                dir_name for dir_name in dir_names if dir_name != "__pycache__"
+            ]
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # editors often write tmp files and remove them straight away
+                    continue
+                result[path] = (stat.st_size, stat.st_mtime_ns)
+    return result
 
-    print(format((time() - start), ".2f") + "s")
+
+def handle_changed_paths(changed_paths, worker_pool, makefile_args):
+    changed_vehicle_module_names = []
+    for path in changed_paths:
+        if os.path.dirname(path) == os.path.join(currentdir, "src", "vehicles"):
+            module_name, extension = os.path.splitext(os.path.basename(path))
+            if extension != ".py":
+                continue
+            if module_name == "__init__":
+                # other modules hold references to the registry in here, so it can't be reloaded
+                print("Restart to pick up changes to", path)
+                continue
+            changed_vehicle_module_names.append("vehicles." + module_name)
+    changed_template_paths = [
+        path
+        for path in changed_paths
+        if path.startswith(os.path.join(currentdir, "src", "templates"))
+    ]
+    if len(changed_vehicle_module_names) > 0:
+        iron_horse.reload_model(changed_vehicle_module_names)
+    # the dependency manifest finds the affected spritesheets, whether from changed pngs, or changed vehicle modules
+    render_stale_tasks(worker_pool, makefile_args)
+    for dir_name in unprocessed_graphics_dir_names:
+        if any(
+            path.startswith(os.path.join(graphics_input_path, dir_name))
+            for path in changed_paths
+        ):
+            copy_unprocessed_graphics_dir(dir_name)
+    if len(changed_vehicle_module_names) > 0 or len(changed_template_paths) > 0:
+        # nml is rendered as a whole, but from the model already in this process, and templates reload themselves when changed
+        import render_nml
+
+        render_nml.main()
+
+
+def watch():
+    # long-running mode for iterating on spritesheets and vehicles, the model stays loaded and the worker pool stays warm between changes
+    # chameleon only checks templates for changes if this is set before it's imported
+    os.environ["CHAMELEON_RELOAD"] = "true"
+    makefile_args = utils.get_makefile_args(sys)
+    iron_horse.main()
+    worker_pool = WorkerPool(makefile_args.get("num_pool_workers", 0))
+    main(worker_pool=worker_pool)
+    print("Watching", ", ".join(watch_paths), "for changes (ctrl-c to stop)")
+    file_stats = get_watched_file_stats()
+    try:
+        while True:
+            sleep(watch_poll_interval)
+            new_file_stats = get_watched_file_stats()
+            changed_paths = sorted(
+                path
+                for path in set(file_stats.keys()) | set(new_file_stats.keys())
+                if file_stats.get(path) != new_file_stats.get(path)
+            )
+            file_stats = new_file_stats
+            if len(changed_paths) == 0:
+                continue
+            start = time()
+            print("Changed:", ", ".join(changed_paths))
+            try:
+                handle_changed_paths(changed_paths, worker_pool, makefile_args)
+            except Exception:
+                # keep watching, the error is probably in the file just saved, and will be fixed in the next one
+                traceback.print_exc()
+            print("Change handled in", format((time() - start), ".2f") + "s")
+    except KeyboardInterrupt:
+        pass
+    worker_pool.close()
 
 
 if __name__ == "__main__":
-    main()
+    if "--watch" in sys.argv:
+        watch()
+    else:
+        main()
@@ -1,5 +1,6 @@
 print("[RENDER LANG] render_lang.py")
 
+import depfiles
 import iron_horse
 import utils
 from polar_fox import git_info
@@ -42,8 +43,9 @@ hint_file.close()
 
 def main():
     start = time()
+    depfiles.start_recording()
     iron_horse.main()
-    consists = iron_horse.ActiveRosters().consists_in_buy_menu_order
+    consists = iron_horse.get_active_rosters().consists_in_buy_menu_order
 
     languages_with_generation = ("english",)
     for i in languages_with_generation:
@@ -62,6 +64,8 @@ def main():
         dst_file.write(lang_content)
         dst_file.close()
 
+    depfiles.write_depfile(os.path.join(lang_dst, "english.lng"), "lang")
+
     print(format((time() - start), ".2f") + "s")
 
 
@@ -8,6 +8,7 @@ import os
 currentdir = os.curdir
 from time import time
 
+import depfiles
 import iron_horse
 import utils
 import global_constants
@@ -40,7 +41,7 @@ def render_header_item_nml(header_item, consists):
             temp_storage_ids=global_constants.temp_storage_ids,  # convenience measure
             utils=utils,
             registered_railtypes=iron_horse.get_active_railtypes(),
-            active_rosters=iron_horse.ActiveRosters(),
+            active_rosters=iron_horse.get_active_rosters(),
             graphics_path=global_constants.graphics_path,
             makefile_args=makefile_args,
             git_info=git_info,
@@ -62,6 +63,7 @@ def render_item_nml(item):
 
 def main():
     start = time()
+    depfiles.start_recording()
     iron_horse.main()
     print(iron_horse.vacant_numeric_ids_formatted())
 
@@ -74,7 +76,7 @@ def main():
     )
 
     spritelayer_cargos = iron_horse.registered_spritelayer_cargos
-    consists = iron_horse.ActiveRosters().consists_in_buy_menu_order
+    consists = iron_horse.get_active_rosters().consists_in_buy_menu_order
 
     header_items = [
         "header",
@@ -109,6 +111,10 @@ def main():
 
     grf_nml.close()
 
+    depfiles.write_depfile(
+        os.path.join(global_constants.generated_files_dir, "iron-horse.nml"), "nml"
+    )
+
     print(format((time() - start), ".2f") + "s")
 
 
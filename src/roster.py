@@ -31,6 +31,12 @@ class Roster(object):
         self.livery_presets = kwargs.get("livery_presets", [])
         self.disabled = False
 
+    def __getstate__(self):
+        # engines is a list of modules, which won't pickle, and it's only used by register()
+        state = self.__dict__.copy()
+        state["engines"] = None
+        return state
+
     @property
     def buy_menu_sort_order(self):
         result = []
@@ -68,34 +74,53 @@ class Roster(object):
                         }[wagon_consist.subtype],
                     )
                 )
-        for consist in result:
+        return result
+
+    def audit_picklability(self):
+        for consist in self.consists_in_buy_menu_order:
             # if consist won't pickle, then multiprocessing blows up, catching it here is faster and easier
             try:
                 pickle.dumps(consist)
             except:
                 print("Pickling failed for consist:", consist.id)
                 raise
-        return result
 
-    def get_wagon_randomisation_candidates(self, randomisation_consist):
-        result = []
+    def compile_wagon_randomisation_candidates(self):
+        # randomised wagons pick from candidate wagons matching on candidate group, track type, gen and subtype
+        # index the candidates once all wagons are registered, rather than scanning all wagons for each randomised wagon
+        self.wagon_randomisation_candidates_index = {}
         for base_id, wagons in self.wagon_consists.items():
             for wagon_consist in wagons:
-                if (
-                    randomisation_consist.base_id
-                    not in wagon_consist.randomised_candidate_groups
+                # dict.fromkeys to drop any repeated groups, preserving order
+                for randomised_candidate_group in dict.fromkeys(
+                    wagon_consist.randomised_candidate_groups
                 ):
-                    continue
-                if (
-                    randomisation_consist.base_track_type
-                    != wagon_consist.base_track_type
-                ):
-                    continue
-                if randomisation_consist.gen != wagon_consist.gen:
-                    continue
-                if randomisation_consist.subtype != wagon_consist.subtype:
-                    continue
-                result.append(wagon_consist)
+                    self.wagon_randomisation_candidates_index.setdefault(
+                        (
+                            randomised_candidate_group,
+                            wagon_consist.base_track_type,
+                            wagon_consist.gen,
+                            wagon_consist.subtype,
+                        ),
+                        [],
+                    ).append(wagon_consist)
+        # padded results per randomised consist id, filled on first use
+        self.wagon_randomisation_candidates = {}
+
+    def get_wagon_randomisation_candidates(self, randomisation_consist):
+        if randomisation_consist.id in self.wagon_randomisation_candidates:
+            return self.wagon_randomisation_candidates[randomisation_consist.id]
+        result = list(
+            self.wagon_randomisation_candidates_index.get(
+                (
+                    randomisation_consist.base_id,
+                    randomisation_consist.base_track_type,
+                    randomisation_consist.gen,
+                    randomisation_consist.subtype,
+                ),
+                [],
+            )
+        )
         if len(result) == 0:
             raise BaseException(
                 randomisation_consist.id
@@ -125,6 +150,7 @@ class Roster(object):
             result.extend(result[: 8 - len(result)])
         if len(result) >= 9:
             result.extend(result[: 16 - len(result)])
+        self.wagon_randomisation_candidates[randomisation_consist.id] = result
         return result
 
     def intro_date_ranges(self, base_track_type):
@@ -137,6 +163,88 @@ class Roster(object):
         result.reverse()
         return result
 
+    def compile_tech_tree(self):
+        # replacement_consist, replaces_consists and similar_consists are used per vehicle by nml and docs templates
+        # finding them by scanning all the engines for each engine is O(n^2), so index them all once, after the engines are registered
+        # engines in a tech tree branch, keyed by (role, role_child_branch_num, base_track_type), ordered by intro date
+        self.tech_tree_branches = {}
+        for consist in self.engine_consists:
+            self.tech_tree_branches.setdefault(
+                (consist.role, consist.role_child_branch_num, consist.base_track_type),
+                [],
+            ).append(consist)
+        for branch in self.tech_tree_branches.values():
+            branch.sort(key=lambda consist: consist.intro_date)
+
+        engine_consists_by_id = dict(
+            (consist.id, consist) for consist in self.engine_consists
+        )
+        self.tech_tree_replacement_consists = {}
+        self.tech_tree_replaced_consists = dict(
+            (consist.id, []) for consist in self.engine_consists
+        )
+        for consist in self.engine_consists:
+            # option exists to force a replacement consist, this is used to merge tech tree branches
+            if consist._replacement_consist_id is not None:
+                if consist._replacement_consist_id not in engine_consists_by_id:
+                    # probably a broken replacement id
+                    raise Exception(
+                        "replacement consist id "
+                        + consist._replacement_consist_id
+                        + " not found for consist "
+                        + consist.id
+                    )
+                replacement_consist = engine_consists_by_id[
+                    consist._replacement_consist_id
+                ]
+            else:
+                replacement_consist = None
+                for candidate in self.tech_tree_branches[
+                    (
+                        consist.role,
+                        consist.role_child_branch_num,
+                        consist.base_track_type,
+                    )
+                ]:
+                    if candidate.intro_date > consist.intro_date:
+                        replacement_consist = candidate
+                        break
+            self.tech_tree_replacement_consists[consist.id] = replacement_consist
+            if replacement_consist is not None:
+                # a consist can replace more than one other consist
+                self.tech_tree_replaced_consists[replacement_consist.id].append(consist)
+
+        # quite a crude guess at similar engines by role or power, within the same track type and gen
+        engine_consists_by_track_type_and_gen = {}
+        for consist in self.engine_consists:
+            engine_consists_by_track_type_and_gen.setdefault(
+                (consist.base_track_type, consist.gen), []
+            ).append(consist)
+        self.tech_tree_similar_consists = {}
+        for consist in self.engine_consists:
+            self.tech_tree_similar_consists[consist.id] = [
+                candidate
+                for candidate in engine_consists_by_track_type_and_gen[
+                    (consist.base_track_type, consist.gen)
+                ]
+                if candidate != consist
+                and (
+                    (candidate.role == consist.role)
+                    or (0 <= (candidate.power - consist.power) < 500)
+                    or (0 <= (consist.power - candidate.power) < 500)
+                )
+            ]
+
+    def freeze(self):
+        # registration is complete, so this is also where roster-wide indexes that need all the wagons are built
+        self.compile_wagon_randomisation_candidates()
+        # all consists, not just the ones in the buy menu order
+        for consist in self.engine_consists:
+            consist.freeze()
+        for wagon_consists in self.wagon_consists.values():
+            for wagon_consist in wagon_consists:
+                wagon_consist.freeze()
+
     def register_wagon_consist(self, wagon_consist):
         self.wagon_consists[wagon_consist.base_id].append(wagon_consist)
         wagon_consist.roster_id = self.id
@@ -147,6 +255,7 @@ class Roster(object):
         for engine in self.engines:
             consist = engine.main(self.id)
             self.engine_consists.append(consist)
+        self.compile_tech_tree()
         self.wagon_consists = dict(
             [(base_id, []) for base_id in global_constants.buy_menu_sort_order_wagons]
         )
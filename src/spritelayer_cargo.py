@@ -8,8 +8,10 @@ from spritelayer_cargos import registered_spritelayer_cargos
 class SpritelayerCargo(object):
     """Simple generic class for spritelayer cargos"""
 
+    # set by subclass, it's a class attribute so the registry can key on it without instantiating
+    base_id = None
+
     def __init__(self, **kwargs):
-        self.base_id = None  # set by subclass
         self.platform_type = kwargs.get("platform_type")
         self.length = kwargs.get("length")
         self.cargo_sets = []
@@ -57,20 +59,9 @@ class CargoSetBase(object):
 
     def register_cargo_set(self, spritelayer_cargo_type):
         for platform_type in self.compatible_platform_types:
-            spritelayer_cargo = spritelayer_cargo_type(
-                platform_type=platform_type,
-                length=self.length,
+            spritelayer_cargo = registered_spritelayer_cargos.get_or_register(
+                spritelayer_cargo_type, platform_type, self.length
             )
-            # the spritelayer_cargo may already be registered, this is a valid side effect of the implementation
-            # but we don't want to register the same spritelayer_cargo multiple times (waste of compile time and can cause bugs with multiprocessing)
-            already_registered = False
-            for registered_spritelayer_cargo in registered_spritelayer_cargos:
-                if registered_spritelayer_cargo.id == spritelayer_cargo.id:
-                    already_registered = True
-                    spritelayer_cargo = registered_spritelayer_cargo
-                    break
-            if already_registered == False:
-                registered_spritelayer_cargos.append(spritelayer_cargo)
             # print("registering", spritelayer_cargo.id, spritelayer_cargo.platform_type, self.subtype, self.subtype_suffix)
             spritelayer_cargo.cargo_sets.append(self)
 
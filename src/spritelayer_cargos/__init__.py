@@ -1,3 +1,31 @@
 # spritelayer cargos are sandboxed into their own module to avoid them spawning tentacles into gestalt graphics, global constants, train.py etc
 
-registered_spritelayer_cargos = []
+
+class SpritelayerCargoRegistry(object):
+    """
+    Spritelayer cargos keyed by (base_id, platform_type, length), so cargo sets can find an existing spritelayer cargo without a scan.
+    Iterates over the spritelayer cargos in registration order, so it can be used like a list.
+    """
+
+    def __init__(self):
+        # dicts preserve insertion order, which gives registration order for iteration
+        self.spritelayer_cargos = {}
+
+    def get_or_register(self, spritelayer_cargo_type, platform_type, length):
+        # the spritelayer cargo may already be registered by another cargo set, this is a valid side effect of the implementation
+        # but we don't want to register the same spritelayer_cargo multiple times (waste of compile time and can cause bugs with multiprocessing)
+        key = (spritelayer_cargo_type.base_id, platform_type, length)
+        if key not in self.spritelayer_cargos:
+            self.spritelayer_cargos[key] = spritelayer_cargo_type(
+                platform_type=platform_type, length=length
+            )
+        return self.spritelayer_cargos[key]
+
+    def __iter__(self):
+        return iter(self.spritelayer_cargos.values())
+
+    def __len__(self):
+        return len(self.spritelayer_cargos)
+
+
+registered_spritelayer_cargos = SpritelayerCargoRegistry()
@@ -8,9 +8,10 @@ from spritelayer_cargo import SpritelayerCargo, CargoSetBase
 class AutomobilesSpritelayerCargo(SpritelayerCargo):
     """Base class for automobile spritelayer cargo - cars, trucks, tractors etc."""
 
+    base_id = "automobiles"
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.base_id = "automobiles"
         self.gestalt_graphics = GestaltGraphicsAutomobilesTransporter()
 
     @property
@@ -10,9 +10,10 @@ from spritelayer_cargo import SpritelayerCargo, CargoSetBase
 class IntermodalContainersSpritelayerCargo(SpritelayerCargo):
     """Base class for the containers spritelayer cargo"""
 
+    base_id = "intermodal_containers"
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.base_id = "intermodal_containers"
         self.gestalt_graphics = GestaltGraphicsIntermodalContainerTransporters()
         self.provide_container_shadows = True
 
@@ -37,10 +37,72 @@ from gestalt_graphics.gestalt_graphics import (
 import gestalt_graphics.graphics_constants as graphics_constants
 
 from rosters import registered_rosters
-from vehicles import numeric_id_defender
+from vehicles import numeric_id_registry
 import iron_horse
 import spritelayer_cargos
 
+# set IRON_HORSE_VERIFY_FROZEN=1 to check every frozen property against a live recompute whenever it's read
+# slow, only for debugging suspected stale values
+verify_frozen_properties = os.environ.get("IRON_HORSE_VERIFY_FROZEN", "0") == "1"
+
+
+class frozen_property(object):
+    """
+    Read-only property for values derived from other vehicle properties, which templates read many times.
+    Computed on every access until the vehicle is frozen, then served from the values stored by freeze().
+    Sub-classes over-riding a frozen property should use this decorator too.
+    """
+
+    def __init__(self, fget):
+        self.fget = fget
+        self.name = fget.__name__
+        self.__doc__ = fget.__doc__
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        frozen_values = instance.__dict__.get("_frozen_values", None)
+        if frozen_values is None:
+            return self.fget(instance)
+        if verify_frozen_properties:
+            live_value = self.fget(instance)
+            if live_value != frozen_values[self.name]:
+                raise BaseException(
+                    "frozen value for "
+                    + self.name
+                    + " on "
+                    + instance.id
+                    + " is stale: "
+                    + repr(frozen_values[self.name])
+                    + " frozen, "
+                    + repr(live_value)
+                    + " live"
+                )
+        return frozen_values[self.name]
+
+    def __set__(self, instance, value):
+        raise AttributeError("can't set frozen_property " + self.name)
+
+
+def freeze_vehicle(vehicle, frozen_property_names):
+    # shared by consists and units, stores the current value of each property, and blocks any further attribute setting
+    frozen_values = {}
+    for name in frozen_property_names:
+        frozen_values[name] = getattr(vehicle, name)
+    # set via __dict__ as __setattr__ won't allow it once frozen
+    vehicle.__dict__["_frozen_values"] = frozen_values
+
+
+def guard_frozen_setattr(vehicle, name):
+    if "_frozen_values" in vehicle.__dict__:
+        raise BaseException(
+            "can't set "
+            + name
+            + " on "
+            + str(vehicle.id)
+            + ", vehicles are frozen once all vehicles are registered"
+        )
+
 
 class Consist(grf.SpriteGenerator):
     """
@@ -157,6 +219,35 @@ class Consist(grf.SpriteGenerator):
         # aids 'project management'
         self.sprites_complete = kwargs.get("sprites_complete", False)
 
+    # derived properties that are cached by freeze()
+    frozen_property_names = [
+        "roster",
+        "gen",
+        "intro_date",
+        "intro_date_days_offset",
+        "unique_units",
+        "speed",
+        "buy_cost",
+        "running_cost",
+    ]
+
+    def __setattr__(self, name, value):
+        guard_frozen_setattr(self, name)
+        super().__setattr__(name, value)
+
+    def freeze(self):
+        # called by iron_horse.main() once all vehicles are registered, after that nothing these properties depend on can change
+        for unit in self.unique_units:
+            unit.freeze()
+        freeze_vehicle(self, self.frozen_property_names)
+
+    def __getstate__(self):
+        # frozen values include the roster, which won't pickle (it holds modules)
+        # so pickled copies are unfrozen, and compute these properties live
+        state = self.__dict__.copy()
+        state.pop("_frozen_values", None)
+        return state
+
     def add_unit(self, type, repeat=1, **kwargs):
         unit = type(consist=self, **kwargs)
         count = len(self.unique_units)
@@ -165,11 +256,11 @@ class Consist(grf.SpriteGenerator):
             unit.id = self.id
         else:
             unit.id = self.id + "_" + str(count)
-        unit.numeric_id = self.get_and_verify_numeric_id(count)
+        unit.numeric_id = self.get_and_verify_numeric_id(count, unit)
         for repeat_num in range(repeat):
             self.units.append(unit)
 
-    @property
+    @frozen_property
     def unique_units(self):
         # units may be repeated in the consist, sometimes we need an ordered list of unique units
         # set() doesn't preserve list order, which matters, so do it the hard way
@@ -190,7 +281,7 @@ class Consist(grf.SpriteGenerator):
                 result.append(unit + 1)
         return result
 
-    def get_and_verify_numeric_id(self, offset):
+    def get_and_verify_numeric_id(self, offset, unit):
         numeric_id = self.base_numeric_id + offset
         # guard against the ID being too large to build in an articulated consist
         if numeric_id > 16383:
@@ -202,16 +293,20 @@ class Consist(grf.SpriteGenerator):
                 + " can't be used (16383 is max ID for articulated vehicles)"
             )
         # non-blocking guard on duplicate IDs
-        for id in numeric_id_defender:
-            if id == numeric_id:
-                utils.echo_message(
-                    "Error: consist "
-                    + self.id
-                    + " unit id collides ("
-                    + str(numeric_id)
-                    + ") with units in another consist"
-                )
-        numeric_id_defender.append(numeric_id)
+        collision = numeric_id_registry.register(numeric_id, self, unit)
+        if collision is not None:
+            utils.echo_message(
+                "Error: consist "
+                + self.id
+                + " unit "
+                + unit.id
+                + " id collides ("
+                + str(numeric_id)
+                + ") with consist "
+                + collision[0].id
+                + " unit "
+                + collision[1].id
+            )
         return numeric_id
 
     @property
@@ -256,19 +351,19 @@ class Consist(grf.SpriteGenerator):
         else:
             return False
 
-    @property
+    @frozen_property
     def buy_cost(self):
         # stub only
         # vehicle classes should over-ride this to provide class-appropriate cost calculation
         return 0
 
-    @property
+    @frozen_property
     def running_cost(self):
         # stub only
         # vehicle classes should over-ride this to provide class-appropriate running cost calculation
         return 0
 
-    @property
+    @frozen_property
     def intro_date(self):
         # automatic intro_date, but can over-ride by passing in kwargs for consist
         if self._intro_date:
@@ -291,7 +386,7 @@ class Consist(grf.SpriteGenerator):
                 result = result + self.intro_date_offset
             return result
 
-    @property
+    @frozen_property
     def intro_date_days_offset(self):
         # days offset is used to control *synchronising* (or not) intro dates across groups of vehicles where needed
         # see https://github.com/OpenTTD/OpenTTD/pull/7147 for explanation
@@ -371,7 +466,7 @@ class Consist(grf.SpriteGenerator):
             )
         return result
 
-    @property
+    @frozen_property
     def gen(self):
         # gen is usually set in the vehicle, but can be left unset if intro_date is set
         if self._gen:
@@ -400,67 +495,18 @@ class Consist(grf.SpriteGenerator):
 
     @property
     def replacement_consist(self):
-        # option exists to force a replacement consist, this is used to merge tech tree branches
-        if self.role_child_branch_num == 0:
-            print("OOF", self.id, self.role_child_branch_num)
-
-        if self._replacement_consist_id is not None:
-            for consist in self.roster.engine_consists:
-                if consist.id == self._replacement_consist_id:
-                    return consist
-            # if we don't return a valid result, that's an error, probably a broken replacement id
-            raise Exception(
-                "replacement consist id "
-                + self._replacement_consist_id
-                + " not found for consist "
-                + self.id
-            )
-        else:
-            similar_consists = []
-            replacement_consist = None
-            for consist in self.roster.engine_consists:
-                if (
-                    (consist.role == self.role)
-                    and (consist.role_child_branch_num == self.role_child_branch_num)
-                    and (consist.base_track_type == self.base_track_type)
-                ):
-                    similar_consists.append(consist)
-            for consist in sorted(
-                similar_consists, key=lambda consist: consist.intro_date
-            ):
-                if consist.intro_date > self.intro_date:
-                    replacement_consist = consist
-                    break
-            return replacement_consist
+        # tech tree lookups are indexed by the roster, see Roster.compile_tech_tree()
+        return self.roster.tech_tree_replacement_consists[self.id]
 
     @property
     def replaces_consists(self):
-        # note that this depends on replacement_consist property in other consists, and may not work in all cases
         # a consist can replace more than one other consist
-        result = []
-        for consist in self.roster.engine_consists:
-            if consist.replacement_consist is not None:
-                if consist.replacement_consist.id == self.id:
-                    result.append(consist)
-        return result
+        return self.roster.tech_tree_replaced_consists[self.id]
 
     @property
     def similar_consists(self):
         # quite a crude guess at similar engines by role
-        result = []
-        for consist in self.roster.engine_consists:
-            if (
-                (consist.base_track_type == self.base_track_type)
-                and (consist.gen == self.gen)
-                and (consist != self)
-            ):
-                if (
-                    (consist.role == self.role)
-                    or (0 <= (consist.power - self.power) < 500)
-                    or (0 <= (self.power - consist.power) < 500)
-                ):
-                    result.append(consist)
-        return result
+        return self.roster.tech_tree_similar_consists[self.id]
 
     @property
     def model_life(self):
@@ -509,7 +555,7 @@ class Consist(grf.SpriteGenerator):
         speeds_by_track_type = self.roster.speeds[self.base_track_type]
         return speeds_by_track_type[speed_class][self.gen - 1]
 
-    @property
+    @frozen_property
     def speed(self):
         if self._speed:
             return self._speed
@@ -578,7 +624,7 @@ class Consist(grf.SpriteGenerator):
         # over-ride in subclass as needed
         return self._loading_speed_multiplier
 
-    @property
+    @frozen_property
     def roster(self):
         for roster in registered_rosters:
             if roster.id == self.roster_id:
@@ -833,16 +879,6 @@ class Consist(grf.SpriteGenerator):
         else:
             return ""
 
-    def freeze_cross_roster_lookups(self):
-        # graphics processing can't depend on roster object reliably, as it blows up multiprocessing (can't pickle roster), for reasons I never figured out
-        # this freezes any necessary roster items in place
-        self.frozen_roster_items = {}
-        if self.gestalt_graphics.__class__.__name__ == "GestaltGraphicsRandomisedWagon":
-            self.frozen_roster_items[
-                "wagon_randomisation_candidates"
-            ] = self.roster.get_wagon_randomisation_candidates(self)
-        # no return
-
     def assert_speed(self):
         # speed is assumed to be limited to 200mph
         # this isn't an OpenTTD limit, it's used to give a scale for buy and run cost spreads
@@ -948,7 +984,7 @@ class EngineConsist(Consist):
             ),
         )
 
-    @property
+    @frozen_property
     def buy_cost(self):
         # max speed = 200mph by design - see assert_speed()
         # multiplier for speed, max value will be 25
@@ -978,7 +1014,7 @@ class EngineConsist(Consist):
         # cap to int for nml
         return int(self.fixed_buy_cost_points + self.gen + buy_cost_points)
 
-    @property
+    @frozen_property
     def running_cost(self):
         # algorithmic calculation of engine run costs
         # as of Feb 2019, it's fixed cost (set by subtype) + floating costs (derived from power, speed, weight)
@@ -1700,7 +1736,7 @@ class TGVMiddleEngineConsistMixin(EngineConsist):
         # match middle engine power to cab engine power
         return self.cab_consist.power
 
-    @property
+    @frozen_property
     def buy_cost(self):
         # match middle engine buy cost to cab engine buy cost
         # engine and wagon base costs are set differently, attempt to compensate for that
@@ -1709,7 +1745,7 @@ class TGVMiddleEngineConsistMixin(EngineConsist):
         adjustment_factor = 6.25 * 2 * abs(global_constants.PR_BUILD_VEHICLE_TRAIN)
         return int(self.cab_consist.buy_cost * adjustment_factor)
 
-    @property
+    @frozen_property
     def running_cost(self):
         # take 49% of cab engine running cost as running cost
         # this is to prevent horrible scaling up of costs with each unit added, but could assume the cab has more cost due to driver, equipment etc
@@ -1784,7 +1820,7 @@ class CarConsist(Consist):
         # over-ride in subclasses to suppress base colour parameter (and always use company colours)
         self.use_wagon_base_colour_parameter = True
 
-    @property
+    @frozen_property
     def buy_cost(self):
         if self.speed is not None:
             speed_cost_points = self.speed
@@ -1801,7 +1837,7 @@ class CarConsist(Consist):
         # int for nml
         return int(buy_cost_points)
 
-    @property
+    @frozen_property
     def running_cost(self):
         if self.speed is not None:
             speed_cost_points = self.speed
@@ -4441,6 +4477,17 @@ class Train(object):
         # optional - a switch name to trigger re-randomising vehicle random bits - over-ride as need in subclasses
         self.random_trigger_switch = None
 
+    # derived properties that are cached by freeze()
+    frozen_property_names = ["vehicle_length"]
+
+    def __setattr__(self, name, value):
+        guard_frozen_setattr(self, name)
+        super().__setattr__(name, value)
+
+    def freeze(self):
+        # called by the consist, see Consist.freeze()
+        freeze_vehicle(self, self.frozen_property_names)
+
     def get_capacity_variations(self, capacity):
         # capacity is variable, controlled by a newgrf parameter
         # allow that integer maths is needed for newgrf cb results; round up for safety
@@ -4481,7 +4528,7 @@ class Train(object):
         # weight can be set explicitly or by methods on subclasses
         return self._weight
 
-    @property
+    @frozen_property
     def vehicle_length(self):
         # length of this unit, either derived from from chassis length, or set explicitly via keyword
         # first guard that one and only one of these props is set
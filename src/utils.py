@@ -6,19 +6,36 @@ from polar_fox import git_info
 
 def get_makefile_args(sys):
     # get args passed by makefile
-    if len(sys.argv) > 1:
+    # flags (e.g. render_graphics.py --watch) aren't makefile args, and can go anywhere, so ignore them
+    args = [arg for arg in sys.argv if not arg.startswith("--")]
+    if len(args) > 1:
         makefile_args = {
-            "num_pool_workers": int(sys.argv[1]),
-            "roster": sys.argv[2],
-            "suppress_cargo_sprites": True if sys.argv[3] == "True" else False,
-            "suppress_docs": True if sys.argv[4] == "True" else False,
+            "num_pool_workers": int(args[1]),
+            "roster": args[2],
+            "suppress_cargo_sprites": True if args[3] == "True" else False,
+            "suppress_docs": True if args[4] == "True" else False,
         }
+        # older invocations only pass 4 args, so the profile is optional
+        if len(args) > 5:
+            if args[5] not in global_constants.build_profiles:
+                raise BaseException(
+                    "Unknown build profile '" + args[5] + "', valid profiles are:",
+                    list(global_constants.build_profiles.keys()),
+                )
+            makefile_args["build_profile"] = args[5]
     else:
         # provide any necessary defaults here
         makefile_args = {}
     return makefile_args
 
 
+def get_build_profile(makefile_args):
+    # returns the settings for the build profile, see global_constants.build_profiles
+    return global_constants.build_profiles[
+        makefile_args.get("build_profile", "release")
+    ]
+
+
 def get_docs_url():
     # not convinced this belongs in utils, but I can't find anywhere better to put it
     # could be in polar fox - method will be common to all grfs? - pass the project name as a var?
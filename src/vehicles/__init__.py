@@ -1 +1,50 @@
-numeric_id_defender = []  # used to guard against overlapping ids, for housekeeping only
+class NumericIDRegistry(object):
+    """
+    Registry of the numeric ids used by units, to guard against overlapping ids, and to find vacant ids, for housekeeping only.
+    Ids are keyed in a dict, so checking for collisions doesn't get slower as more ids are registered.
+    """
+
+    def __init__(self):
+        # numeric id: (consist, unit)
+        self.owners = {}
+
+    def register(self, numeric_id, consist, unit):
+        # non-blocking, returns the (consist, unit) already using the id, if any, otherwise None
+        # the first owner keeps the id
+        if numeric_id in self.owners:
+            return self.owners[numeric_id]
+        self.owners[numeric_id] = (consist, unit)
+        return None
+
+    def get_used_ranges(self):
+        # contiguous runs of used ids, as [first, last] pairs in id order
+        result = []
+        for numeric_id in sorted(self.owners):
+            if len(result) > 0 and numeric_id == result[-1][1] + 1:
+                result[-1][1] = numeric_id
+            else:
+                result.append([numeric_id, numeric_id])
+        return result
+
+    def get_vacant_slots(self, slot_size):
+        # slots are blocks of slot_size ids, starting at multiples of slot_size, and a slot is vacant if its first id is unused
+        # returns the vacant slots below the slot holding the highest used id, and the first slot after that, from where all slots are free
+        # walks the gaps between used ranges, rather than checking every slot in the id space
+        used_ranges = self.get_used_ranges()
+        if len(used_ranges) == 0:
+            return [], 0
+        max_slot = used_ranges[-1][1] - (used_ranges[-1][1] % slot_size)
+        vacant_slots = []
+        gap_start = 0
+        for first, last in used_ranges:
+            # first slot start in the gap before this range, rounding up
+            slot = gap_start + (-gap_start % slot_size)
+            while slot < min(first, max_slot):
+                vacant_slots.append(slot)
+                slot += slot_size
+            gap_start = last + 1
+        return vacant_slots, max_slot + slot_size
+
+
+# one registry for all rosters
+numeric_id_registry = NumericIDRegistry()
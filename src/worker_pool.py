@@ -0,0 +1,155 @@
+import json
+import os
+import queue
+import time
+import multiprocessing
+
+import global_constants
+
+currentdir = os.curdir
+
+# timings from the previous run, so the longest tasks can be started first next time
+timings_path = os.path.join(
+    currentdir, global_constants.generated_files_dir, "worker_pool_timings.json"
+)
+
+
+def run_task(task):
+    # runs in the worker process
+    # task is (task_id, function, key), function must be a module-level function, so it pickles by name
+    # key is something small (an id, index, or a render plan) that the function works on, it's pickled to the worker
+    task_id, function, key = task
+    start = time.time()
+    result = function(key)
+    return task_id, result, time.time() - start
+
+
+class WorkerPool(object):
+    """
+    Long-lived pool of worker processes, created once and used for every stage of a run.
+    Tasks only pass small keys (ids, render plans) to workers, never pickled consists or rosters.
+    Workers are forked, so tasks keyed on an id can still look up objects built before the pool was created.
+    With num_pool_workers = 0, tasks are run in this process, which makes debugging easier (mp fails to pickle errors correctly).
+    """
+
+    def __init__(self, num_pool_workers):
+        self.num_pool_workers = num_pool_workers
+        self.timings = {}
+        if os.path.exists(timings_path):
+            with open(timings_path) as timings_file:
+                self.timings = json.load(timings_file)
+        if num_pool_workers > 0:
+            # fork explicitly, it's not the default start method everywhere, and workers depend on inheriting state
+            self.pool = multiprocessing.get_context("fork").Pool(
+                processes=num_pool_workers
+            )
+        else:
+            self.pool = None
+
+    def get_timing(self, task_id):
+        # tasks with no recorded timing go first, they might be slow
+        return self.timings.get(repr(task_id), float("inf"))
+
+    def get_chunksize(self, num_tasks):
+        # chunks cut IPC overhead for many small tasks, but big chunks leave cores idle at the end of the run
+        return max(1, min(8, num_tasks // (4 * self.num_pool_workers)))
+
+    def run_tasks(self, tasks, dependencies):
+        # tasks is a dict of task_id: (function, key), dependencies is a dict of task_id: [task_ids it depends on]
+        # each task is started as soon as all the tasks it depends on have finished, so there are no barriers between groups of tasks
+        # tasks with no dependencies are streamed to the pool longest first, tasks with dependencies are submitted as those finish
+        # returns a dict of task_id: result, in order of completion
+        dependents = {task_id: [] for task_id in tasks}
+        num_waiting_on = {}
+        for task_id in tasks:
+            # dependencies not in this run (e.g. consists not in the roster being built) are assumed to be already generated, or not needed
+            task_dependencies = set(
+                dependency
+                for dependency in dependencies.get(task_id, [])
+                if dependency in tasks and dependency != task_id
+            )
+            num_waiting_on[task_id] = len(task_dependencies)
+            for dependency in task_dependencies:
+                dependents[dependency].append(task_id)
+        ready = sorted(
+            [task_id for task_id in tasks if num_waiting_on[task_id] == 0],
+            key=self.get_timing,
+            reverse=True,
+        )
+        results = {}
+        # pool callbacks run in a pool thread, so dependent tasks are passed back to this thread on a queue
+        completed = queue.Queue()
+        num_submitted = [0]
+
+        def submit(task_id):
+            task = (task_id,) + tasks[task_id]
+            num_submitted[0] += 1
+            if self.pool is None:
+                completed.put((run_task(task), None))
+            else:
+                self.pool.apply_async(
+                    run_task,
+                    (task,),
+                    callback=lambda result: completed.put((result, None)),
+                    error_callback=lambda error: completed.put((None, error)),
+                )
+
+        def handle_result(result):
+            task_id, task_result, elapsed = result
+            self.timings[repr(task_id)] = elapsed
+            results[task_id] = task_result
+            for dependent in dependents[task_id]:
+                num_waiting_on[dependent] -= 1
+                if num_waiting_on[dependent] == 0:
+                    submit(dependent)
+
+        def handle_completed(block):
+            while True:
+                try:
+                    result, error = completed.get(block=block)
+                except queue.Empty:
+                    return
+                if error is not None:
+                    raise error
+                handle_result(result)
+                num_submitted[0] -= 1
+                if num_submitted[0] == 0:
+                    return
+
+        if self.pool is None:
+            for task_id in ready:
+                submit(task_id)
+                handle_completed(block=True)
+        else:
+            for result in self.pool.imap_unordered(
+                run_task,
+                [(task_id,) + tasks[task_id] for task_id in ready],
+                chunksize=self.get_chunksize(len(ready)),
+            ):
+                handle_result(result)
+                handle_completed(block=False)
+            if num_submitted[0] > 0:
+                handle_completed(block=True)
+
+        if len(results) < len(tasks):
+            raise BaseException(
+                "Tasks have circular dependencies:",
+                [task_id for task_id in tasks if num_waiting_on[task_id] > 0],
+            )
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        # other scripts may have recorded timings for their own tasks since this pool was created, so merge rather than replace
+        timings = {}
+        if os.path.exists(timings_path):
+            with open(timings_path) as timings_file:
+                timings = json.load(timings_file)
+        timings.update(self.timings)
+        os.makedirs(os.path.dirname(timings_path), exist_ok=True)
+        timings_path_tmp = timings_path + "." + str(os.getpid()) + ".tmp"
+        with open(timings_path_tmp, "w") as timings_file:
+            json.dump(timings, timings_file, indent=4, sort_keys=True)
+        os.replace(timings_path_tmp, timings_path)